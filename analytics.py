@@ -0,0 +1,245 @@
+"""Analítica de renovaciones: retención por cohorte, churn por servicio y
+vendedor, y LTV por moneda.
+
+Se lee una sola vez una foto por columnas de todas las suscripciones
+(operativas y archivadas) y todo lo demás son operaciones de numpy sobre
+esos arreglos, sin consultas por cliente ni self-joins.
+"""
+from datetime import date
+import time
+
+import numpy as np
+
+from app import db, Account, Seller, subscription_history, reporting, RENOVACION_GRACIA_DIAS
+
+# Meses de seguimiento por cohorte
+COHORTE_MESES = 12
+
+# Filas leídas del cursor por bloque
+SNAPSHOT_CHUNK = 100_000
+
+SNAPSHOT_DTYPE = np.dtype([
+    ('id', 'i8'), ('client', 'i8'), ('account', 'i8'), ('seller', 'i8'),
+    ('start', 'U10'), ('end', 'U10'), ('price', 'f8'), ('currency', 'U3'), ('renewed_from', 'i8'),
+])
+
+
+# --- FOTO POR COLUMNAS ---
+
+def _codes(values):
+    """Etiquetas ordenadas y código entero de cada valor."""
+    labels, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return [str(label) for label in labels], codes
+
+
+def _lookup(table, keys, missing):
+    """table[keys], con `missing` para las claves fuera de rango."""
+    inside = (keys >= 0) & (keys < len(table))
+    return np.where(inside, table[np.where(inside, keys, 0)], missing)
+
+
+def load_snapshot() -> dict:
+    """Carga las suscripciones como arreglos de numpy, una entrada por columna.
+
+    Las filas se leen directo del cursor de la base, por bloques, a un arreglo
+    estructurado (sin objetos por fila de SQLAlchemy). Las fechas llegan como
+    texto ISO y numpy las convierte en bloque; servicio y vendedor se resuelven
+    con tablas chicas indexadas por id.
+    """
+    hist = subscription_history()
+    stmt = db.select(
+        hist.c.id, hist.c.client_id, hist.c.account_id, db.func.coalesce(hist.c.seller_id, 0),
+        db.cast(hist.c.start_date, db.String), db.cast(hist.c.end_date, db.String),
+        hist.c.price, hist.c.currency, db.func.coalesce(hist.c.renewed_from_id, 0),
+    )
+    with reporting():
+        connection = db.session.connection()
+        sql = str(stmt.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(sql)
+            parts = []
+            while True:
+                rows = cursor.fetchmany(SNAPSHOT_CHUNK)
+                if not rows:
+                    break
+                parts.append(np.array(rows, dtype=SNAPSHOT_DTYPE))
+        finally:
+            cursor.close()
+
+        services = dict(db.session.execute(db.select(Account.id, Account.service)).all())
+        seller_names = dict(db.session.execute(db.select(Seller.id, Seller.name)).all())
+    data = np.concatenate(parts) if parts else np.empty(0, dtype=SNAPSHOT_DTYPE)
+
+    service_labels, service_codes = _codes(list(services.values()))
+    service_by_account = np.full(max(services, default=0) + 1, len(service_labels), dtype=np.int64)
+    service_by_account[list(services)] = service_codes
+
+    seller_ids = sorted(seller_names)
+    seller_by_id = np.full(max(seller_ids, default=0) + 1, len(seller_ids), dtype=np.int64)
+    seller_by_id[seller_ids] = np.arange(len(seller_ids))
+    seller_labels = [seller_names[i] for i in seller_ids]
+
+    currency_labels, currency_codes = np.unique(data['currency'], return_inverse=True)
+
+    return {
+        'id': data['id'],
+        'client': data['client'],
+        'start': data['start'].astype('datetime64[D]'),
+        'end': data['end'].astype('datetime64[D]'),
+        'price': data['price'],
+        'renewed_from': data['renewed_from'],
+        'service': _lookup(service_by_account, data['account'], len(service_labels)),
+        'services': service_labels + ['(sin cuenta)'],
+        'seller': _lookup(seller_by_id, data['seller'], len(seller_labels)),
+        'sellers': seller_labels + ['(sin vendedor)'],
+        'currency': currency_codes,
+        'currencies': [str(c) for c in currency_labels],
+    }
+
+
+def renewal_outcomes(snap: dict, today: date, grace_days: int = RENOVACION_GRACIA_DIAS):
+    """Máscaras (renovada, decidida) por suscripción.
+
+    Una suscripción está decidida si ya fue renovada o si venció hace más de
+    `grace_days` días; las decididas sin renovar son las perdidas (churn).
+    """
+    renewed = np.isin(snap['id'], snap['renewed_from'][snap['renewed_from'] > 0])
+    cutoff = np.datetime64(today, 'D') - np.timedelta64(grace_days, 'D')
+    decided = renewed | (snap['end'] < cutoff)
+    return renewed, decided
+
+
+# --- MÉTRICAS ---
+
+def churn_by(codes, labels, renewed, decided) -> list:
+    """Renovadas y perdidas por grupo (servicio, vendedor...)."""
+    n = len(labels)
+    total = np.bincount(codes[decided], minlength=n)
+    kept = np.bincount(codes[decided & renewed], minlength=n)
+
+    result = []
+    for idx in np.flatnonzero(total):
+        lost = int(total[idx] - kept[idx])
+        result.append({
+            'nombre': labels[idx],
+            'decididas': int(total[idx]),
+            'renovadas': int(kept[idx]),
+            'perdidas': lost,
+            'churn_pct': round(100.0 * lost / int(total[idx]), 1),
+        })
+    return sorted(result, key=lambda r: r['churn_pct'], reverse=True)
+
+
+def cohort_retention(snap: dict, today: date, months: int = COHORTE_MESES) -> list:
+    """Retención mensual por cohorte (mes de la primera compra de cada cliente).
+
+    Cada suscripción se expande a los meses en que estuvo activa; un cliente
+    cuenta como retenido en el mes k si tuvo alguna activa ese mes. Los meses
+    que todavía no llegaron quedan en None.
+    """
+    if not len(snap['id']):
+        return []
+
+    today_m = np.datetime64(today, 'M').astype(np.int64)
+    start_m = snap['start'].astype('datetime64[M]').astype(np.int64)
+    end_m = np.minimum(snap['end'].astype('datetime64[M]').astype(np.int64), today_m)
+
+    clients, client_idx = np.unique(snap['client'], return_inverse=True)
+    first = np.full(len(clients), np.iinfo(np.int64).max)
+    np.minimum.at(first, client_idx, start_m)
+
+    # Meses activos de cada suscripción, relativos a la cohorte de su cliente
+    lo = start_m - first[client_idx]
+    hi = np.minimum(end_m - first[client_idx], months)
+    keep = hi >= lo
+    lengths = (hi - lo + 1)[keep]
+    sub_idx = np.repeat(np.flatnonzero(keep), lengths)
+    step = np.arange(len(sub_idx)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    offsets = lo[sub_idx] + step
+
+    # Un cliente cuenta una vez por mes aunque tenga varias suscripciones
+    width = months + 1
+    active = np.unique(client_idx[sub_idx] * width + offsets)
+    active_clients, active_offsets = np.divmod(active, width)
+
+    base = first.min()
+    n_cohorts = int(first.max() - base + 1)
+    matrix = np.bincount(
+        (first[active_clients] - base) * width + active_offsets,
+        minlength=n_cohorts * width,
+    ).reshape(n_cohorts, width)
+    sizes = np.bincount(first - base, minlength=n_cohorts)
+
+    result = []
+    for c in np.flatnonzero(sizes):
+        cohort_m = base + c
+        observable = int(today_m - cohort_m)
+        result.append({
+            'cohorte': str(np.datetime64(int(cohort_m), 'M')),
+            'clientes': int(sizes[c]),
+            'retencion_pct': [
+                round(100.0 * matrix[c, k] / sizes[c], 1) if k <= observable else None
+                for k in range(width)
+            ],
+        })
+    return result
+
+
+def ltv_by_currency(snap: dict, renewed, decided) -> list:
+    """Valor de vida del cliente por moneda.
+
+    `ltv_observado` es lo que pagó en promedio cada cliente hasta hoy;
+    `ltv_proyectado` es ticket promedio / churn (vida esperada en compras).
+    """
+    result = []
+    for code, currency in enumerate(snap['currencies']):
+        mask = snap['currency'] == code
+        _, per_client = np.unique(snap['client'][mask], return_inverse=True)
+        n_clients = int(per_client.max()) + 1 if per_client.size else 0
+        if not n_clients:
+            continue
+
+        revenue = np.bincount(per_client, weights=snap['price'][mask])
+        ticket = float(snap['price'][mask].mean())
+        n_decided = int(np.count_nonzero(decided & mask))
+        churn = (n_decided - int(np.count_nonzero(decided & renewed & mask))) / n_decided if n_decided else None
+
+        result.append({
+            'moneda': currency,
+            'clientes': n_clients,
+            'compras_por_cliente': round(float(mask.sum()) / n_clients, 2),
+            'ticket_promedio': round(ticket, 2),
+            'ltv_observado': round(float(revenue.mean()), 2),
+            'churn_pct': round(100.0 * churn, 1) if churn is not None else None,
+            'ltv_proyectado': round(ticket / churn, 2) if churn else None,
+        })
+    return result
+
+
+def build_report(today: date = None, months: int = COHORTE_MESES,
+                 grace_days: int = RENOVACION_GRACIA_DIAS) -> dict:
+    """Reporte completo (listo para JSON) sobre la base actual."""
+    today = today or date.today()
+    t0 = time.perf_counter()
+    snap = load_snapshot()
+    t_load = time.perf_counter()
+
+    renewed, decided = renewal_outcomes(snap, today, grace_days)
+    report = {
+        'fecha': today.isoformat(),
+        'suscripciones': int(len(snap['id'])),
+        'con_linaje': int(np.count_nonzero(snap['renewed_from'])),
+        'meses': months,
+        'gracia_dias': grace_days,
+        'cohortes': cohort_retention(snap, today, months),
+        'churn_servicio': churn_by(snap['service'], snap['services'], renewed, decided),
+        'churn_vendedor': churn_by(snap['seller'], snap['sellers'], renewed, decided),
+        'ltv': ltv_by_currency(snap, renewed, decided),
+    }
+    report['segundos'] = {
+        'lectura': round(t_load - t0, 3),
+        'calculo': round(time.perf_counter() - t_load, 3),
+    }
+    return report
@@ -1,18 +1,227 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import (
+    Flask, render_template, request, redirect, url_for, flash, send_from_directory, jsonify,
+    g, abort, has_app_context, has_request_context, Response, stream_with_context, stream_template,
+)
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import FileSystemBytecodeCache
+from flask_sqlalchemy.session import Session as FlaskSession
 from datetime import datetime, timedelta, date
 from urllib.parse import quote_plus
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+import calendar
+import csv
+import io
+import json
+import math
 import os
-from sqlalchemy import or_
+import re
+import sqlite3
+import threading
+import time
+import click
+from sqlalchemy import or_, and_, update, create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.exc import SQLAlchemyError
 
 app = Flask(__name__)
 
 # --- CONFIG ---
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///streaming.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///streaming.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'cambia-esto-por-algo-mas-seguro'
 
-db = SQLAlchemy(app)
+# Revendedores (tenants): '' (desactivado), 'ruta' (/t/<nombre>/...) o 'subdominio'
+app.config['TENANT_MODE'] = os.getenv('TENANT_MODE', '')
+app.config['TENANT_BASE_DOMAIN'] = os.getenv('TENANT_BASE_DOMAIN', '')    # ej. ventas.com
+# URL por tenant con {tenant}; vacío = un SQLite por tenant en instance/tenants/.
+# En PostgreSQL puede apuntar a otra base o a un schema:
+#   postgresql://u:p@host/ventas?options=-csearch_path%3D{tenant}
+app.config['TENANT_DATABASE_URL'] = os.getenv('TENANT_DATABASE_URL', '')
+app.config['TENANT_ENGINE_CAP'] = int(os.getenv('TENANT_ENGINE_CAP', '16'))  # engines abiertos a la vez
+
+# Reportes en una base aparte, de solo lectura: '' (desactivado), 'snapshot' (copia SQLite
+# refrescada cada REPORTING_SNAPSHOT_MINUTES) o 'replica' (REPORTING_DATABASE_URL, y para
+# los tenants REPORTING_TENANT_DATABASE_URL con {tenant}). Si la copia tiene más de
+# REPORTING_MAX_STALE_MINUTES, los reportes vuelven a leer de la base principal.
+app.config['REPORTING_MODE'] = os.getenv('REPORTING_MODE', '')
+app.config['REPORTING_DATABASE_URL'] = os.getenv('REPORTING_DATABASE_URL', '')
+app.config['REPORTING_TENANT_DATABASE_URL'] = os.getenv('REPORTING_TENANT_DATABASE_URL', '')
+app.config['REPORTING_DIR'] = os.getenv('REPORTING_DIR', '')  # vacío = instance/reportes
+app.config['REPORTING_SNAPSHOT_MINUTES'] = int(os.getenv('REPORTING_SNAPSHOT_MINUTES', '15'))
+app.config['REPORTING_MAX_STALE_MINUTES'] = int(os.getenv('REPORTING_MAX_STALE_MINUTES', '60'))
+
+# Mantenimiento: consultas que se registran como lentas (0 = no registrar) y hora de la madrugada
+app.config['SLOW_QUERY_MS'] = int(os.getenv('SLOW_QUERY_MS', '500'))
+app.config['MAINTENANCE_HOUR'] = int(os.getenv('MAINTENANCE_HOUR', '4'))
+
+# Arranque: compilar plantillas e importar numpy antes de atender (lo hereda cada worker con
+# --preload); el bytecode de las plantillas se guarda en disco (vacío = instance/jinja_cache)
+app.config['STARTUP_WARMUP'] = os.getenv('STARTUP_WARMUP', '1') == '1'
+app.config['JINJA_CACHE_DIR'] = os.getenv('JINJA_CACHE_DIR', '')
+
+
+# --- REVENDEDORES (TENANTS) ---
+#
+# Cada revendedor tiene su propia base. TenantSession elige el engine según
+# g.tenant en cada consulta, así el resto del código sigue usando db.session
+# sin saber de tenants. Los engines se crean al primer uso y los que llevan
+# más tiempo sin usarse se cierran al pasar el tope (LRU).
+
+TENANT_NAME_RE = re.compile(r'^[a-z0-9][a-z0-9_-]{0,39}$')
+
+
+def tenants_dir() -> str:
+    path = os.path.join(app.instance_path, 'tenants')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def tenant_database_url(name: str) -> str:
+    template = app.config['TENANT_DATABASE_URL']
+    if template:
+        return template.format(tenant=name)
+    return 'sqlite:///' + os.path.join(tenants_dir(), f'{name}.db')
+
+
+def list_tenants():
+    """Tenants conocidos: la variable TENANTS o los archivos de instance/tenants/."""
+    if not app.config['TENANT_MODE']:
+        return []
+    configured = os.getenv('TENANTS')
+    if configured:
+        return sorted(t.strip() for t in configured.split(',') if TENANT_NAME_RE.match(t.strip()))
+    return sorted(
+        f[:-3] for f in os.listdir(tenants_dir())
+        if f.endswith('.db') and TENANT_NAME_RE.match(f[:-3])
+    )
+
+
+def tenant_exists(name: str) -> bool:
+    if not name or not TENANT_NAME_RE.match(name):
+        return False
+    if os.getenv('TENANTS') or app.config['TENANT_DATABASE_URL']:
+        return name in list_tenants()
+    return os.path.exists(os.path.join(tenants_dir(), f'{name}.db'))
+
+
+def current_tenant():
+    """Tenant de la petición o contexto actual (None = base principal)."""
+    if not has_app_context():
+        return None
+    if 'tenant' not in g and not has_request_context():
+        # Comandos CLI: TENANT=acme flask archivar
+        return os.getenv('TENANT') or None
+    return g.get('tenant')
+
+
+class TenantEngines:
+    """Engines por tenant con tope LRU; al expulsar uno se cierran sus conexiones.
+
+    url_for arma la URL a partir de la clave (por defecto, el nombre del tenant).
+    """
+
+    def __init__(self, cap: int, url_for=tenant_database_url):
+        self.cap = cap
+        self.url_for = url_for
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str):
+        with self._lock:
+            engine = self._engines.get(name)
+            if engine is not None:
+                self._engines.move_to_end(name)
+                return engine
+
+            engine = create_engine(self.url_for(name), pool_size=2, max_overflow=3)
+            self._engines[name] = engine
+            while len(self._engines) > self.cap:
+                _, evicted = self._engines.popitem(last=False)
+                evicted.dispose()
+            return engine
+
+    def names(self):
+        with self._lock:
+            return list(self._engines)
+
+    def reset(self, close: bool = True):
+        """Descarta todos los engines (close=False después de un fork)."""
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose(close=close)
+            self._engines.clear()
+
+
+tenant_engines = TenantEngines(app.config['TENANT_ENGINE_CAP'])
+reporting_engines = TenantEngines(app.config['TENANT_ENGINE_CAP'], url_for=lambda url: url)  # clave = URL
+
+
+class TenantSession(FlaskSession):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if has_app_context() and g.get('reporting_engine') is not None:
+                return g.reporting_engine  # dentro de `with reporting():`
+            tenant = current_tenant()
+            if tenant:
+                return tenant_engines.get(tenant)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@contextmanager
+def tenant_context(name):
+    """Contexto de app apuntando a la base de un tenant (None = base principal)."""
+    with app.app_context():
+        g.tenant = name
+        yield
+
+
+class TenantMiddleware:
+    """Saca el tenant de la URL antes de que Flask enrute.
+
+    En modo 'ruta', /t/acme/ventas se atiende como /ventas con SCRIPT_NAME
+    /t/acme, así url_for() genera enlaces que se quedan dentro del tenant.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        mode = app.config['TENANT_MODE']
+        tenant = None
+
+        if mode == 'ruta':
+            parts = environ.get('PATH_INFO', '').split('/', 3)  # ['', 't', nombre, resto]
+            if len(parts) >= 3 and parts[1] == 't' and parts[2]:
+                tenant = parts[2]
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + f'/t/{tenant}'
+                environ['PATH_INFO'] = '/' + (parts[3] if len(parts) > 3 else '')
+        elif mode == 'subdominio':
+            host = environ.get('HTTP_HOST', '').split(':')[0].lower()
+            base = app.config['TENANT_BASE_DOMAIN'].lower()
+            if base and host.endswith('.' + base):
+                tenant = host[:-len(base) - 1]
+
+        environ['ventas.tenant'] = tenant
+        return self.wsgi_app(environ, start_response)
+
+
+db = SQLAlchemy(app, session_options={'class_': TenantSession})
+app.wsgi_app = TenantMiddleware(app.wsgi_app)
+
+
+@app.before_request
+def select_tenant():
+    tenant = request.environ.get('ventas.tenant')
+    if tenant is not None and not tenant_exists(tenant):
+        abort(404)
+    g.tenant = tenant
+
+
+@app.context_processor
+def inject_tenant():
+    return {'tenant': g.get('tenant'), 'datos_reporte': g.get('reporting_info')}
 
 # Monedas soportadas
 CURRENCIES = [
@@ -55,6 +264,7 @@ class Seller(db.Model):
     name = db.Column(db.String(120), nullable=False)
     phone = db.Column(db.String(50))
     notes = db.Column(db.Text)
+    commission_pct = db.Column(db.Float, default=0)  # % de comisión sobre sus ventas
 
 
 class Account(db.Model):
@@ -73,19 +283,66 @@ class Subscription(db.Model):
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
     account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
     seller_id = db.Column(db.Integer, db.ForeignKey('seller.id'), nullable=False)
-    start_date = db.Column(db.Date, nullable=False)
-    end_date = db.Column(db.Date, nullable=False)
+    start_date = db.Column(db.Date, nullable=False, index=True)
+    end_date = db.Column(db.Date, nullable=False, index=True)
     price = db.Column(db.Float, nullable=False)
     currency = db.Column(db.String(3), nullable=False, default='BOB')  # BOB, ARS, CLP
     platform = db.Column(db.String(20), nullable=False, default='whatsapp')  # whatsapp/messenger
     payment_status = db.Column(db.String(20), nullable=False, default='pagado')  # pagado/pendiente/renovado
+    payment_status_changed_at = db.Column(db.DateTime, default=datetime.now, index=True)
     status = db.Column(db.String(20), default='activa')  # activa, vencida, pausada
     slot = db.Column(db.String(50))  # nombre del perfil/slot asignado
+    renewed_from_id = db.Column(db.Integer, index=True)  # suscripción que renueva (puede estar archivada)
 
     client = db.relationship('Client', backref=db.backref('subscriptions', lazy=True))
     account = db.relationship('Account', backref=db.backref('subscriptions', lazy=True))
     seller = db.relationship('Seller', backref=db.backref('subscriptions', lazy=True))
 
+    __table_args__ = (
+        # Cubre la línea de vencimientos: agrupa sin leer las filas de la tabla
+        db.Index('ix_subscription_vencimientos', 'end_date', 'account_id', 'currency', 'price'),
+        # Cubre el reporte de vendedores por rango de fechas
+        db.Index('ix_subscription_ventas', 'start_date', 'seller_id', 'currency', 'price', 'renewed_from_id'),
+        # Sin AUTOINCREMENT, SQLite reusa ids borrados o archivados y el historial
+        # mezclaría dos ventas con el mismo id
+        {'sqlite_autoincrement': True},
+    )
+
+    archived = False
+
+
+class SubscriptionArchive(db.Model):
+    """Suscripciones vencidas hace tiempo, movidas fuera de la tabla operativa.
+
+    Mismas columnas (y mismo id) que Subscription; solo la leen el historial
+    del cliente y los reportes.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False, index=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    seller_id = db.Column(db.Integer, db.ForeignKey('seller.id'), nullable=False, index=True)
+    start_date = db.Column(db.Date, nullable=False, index=True)
+    end_date = db.Column(db.Date, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    currency = db.Column(db.String(3), nullable=False, default='BOB')
+    platform = db.Column(db.String(20), nullable=False, default='whatsapp')
+    payment_status = db.Column(db.String(20), nullable=False, default='pagado')
+    payment_status_changed_at = db.Column(db.DateTime)
+    status = db.Column(db.String(20), default='vencida')
+    slot = db.Column(db.String(50))
+    renewed_from_id = db.Column(db.Integer, index=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    client = db.relationship('Client')
+    account = db.relationship('Account')
+    seller = db.relationship('Seller')
+
+    __table_args__ = (
+        db.Index('ix_subscription_archive_ventas', 'start_date', 'seller_id', 'currency', 'price', 'renewed_from_id'),
+    )
+
+    archived = True
+
 
 class MessageTemplate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -95,6 +352,84 @@ class MessageTemplate(db.Model):
     description = db.Column(db.Text)
 
 
+class ClientSummary(db.Model):
+    """Resumen precalculado por cliente; lo mantienen las rutas de ventas."""
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), primary_key=True)
+    active_count = db.Column(db.Integer, nullable=False, default=0)
+    next_expiry = db.Column(db.Date, index=True)      # fin más próximo entre las activas
+    last_purchase = db.Column(db.Date, index=True)    # inicio de la venta más reciente
+    computed_on = db.Column(db.Date)                  # las activas dependen del día de cálculo
+
+    client = db.relationship('Client', backref=db.backref('summary', uselist=False))
+
+
+class ClientSpend(db.Model):
+    """Gasto histórico de cada cliente por moneda."""
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), primary_key=True)
+    currency = db.Column(db.String(3), primary_key=True)
+    total = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_client_spend_currency_total', 'currency', 'total'),
+    )
+
+
+class NotificationLog(db.Model):
+    """Avisos ya enviados por suscripción y tipo (recordatorio/pago)."""
+    id = db.Column(db.Integer, primary_key=True)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)          # recordatorio, pago
+    fingerprint = db.Column(db.String(80), nullable=False)   # fecha de fin / estado de pago avisado
+    sent_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.UniqueConstraint('subscription_id', 'kind', 'fingerprint', name='uq_notification_log'),
+    )
+
+
+class AppState(db.Model):
+    """Valores sueltos que la app necesita recordar entre ejecuciones (marcas de agua, etc.)."""
+    key = db.Column(db.String(80), primary_key=True)
+    value = db.Column(db.Text)
+
+
+class CacheVersion(db.Model):
+    """Versión de cada lista cacheada; sube cada vez que cambian sus datos."""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Job(db.Model):
+    """Trabajo en la cola local (notificaciones, vencimientos, exportaciones...)."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)             # notificar, vencimientos, exportar_ventas
+    payload = db.Column(db.Text)                                # JSON con los parámetros
+    progress = db.Column(db.Text)                               # JSON con el punto de control para reanudar
+    status = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente/en_proceso/hecho/fallido
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    locked_by = db.Column(db.String(80))
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    finished_at = db.Column(db.DateTime)
+
+    lease = None  # (worker, intento) que puso lease_job; no es columna
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+    @property
+    def data(self):
+        return json.loads(self.payload) if self.payload else {}
+
+    @property
+    def checkpoint(self):
+        return json.loads(self.progress) if self.progress else {}
+
+
 # --- MENSAJES POR DEFECTO (PLANTILLAS) ---
 
 DEFAULT_MESSAGES = {
@@ -152,12 +487,22 @@ def build_wa_link(client: Client, text: str):
     return f"https://wa.me/{number}?text={quote_plus(text)}"
 
 
-def render_message(key: str, sub: Subscription) -> str:
-    """Rellena una plantilla (DB o por defecto) con datos de la suscripción."""
+def message_template(key: str) -> str:
+    """Texto de la plantilla `key`: la guardada en la base o la por defecto."""
     tmpl = MessageTemplate.query.filter_by(key=key).first()
-    base = tmpl.content if tmpl else DEFAULT_MESSAGES.get(key, '')
+    return tmpl.content if tmpl else DEFAULT_MESSAGES.get(key, '')
 
-    today = datetime.today().date()
+
+def render_message(key: str, sub: Subscription, base: str = None, today: date = None) -> str:
+    """Rellena una plantilla (DB o por defecto) con datos de la suscripción.
+
+    Para muchos mensajes seguidos, pasar `base` (de message_template) y `today`
+    evita leer la plantilla una vez por suscripción.
+    """
+    if base is None:
+        base = message_template(key)
+
+    today = today or datetime.today().date()
     dias_restantes = (sub.end_date - today).days
 
     data = {
@@ -184,6 +529,1401 @@ def render_message(key: str, sub: Subscription) -> str:
     return text
 
 
+# Plantillas que se pueden mandar en campaña
+CAMPAIGN_KINDS = [
+    ('recordatorio', 'Recordatorio'),
+    ('pago', 'Pago'),
+    ('entrega', 'Entrega'),
+]
+
+
+def campaign_messages(key: str, subs, today: date = None) -> list:
+    """Mensaje y enlace wa.me para cada suscripción, leyendo la plantilla una sola vez.
+
+    Las suscripciones deben venir con cliente, cuenta y vendedor ya cargados.
+    """
+    base = message_template(key)
+    today = today or datetime.today().date()
+
+    rows = []
+    for sub in subs:
+        msg = render_message(key, sub, base, today)
+        rows.append({
+            'sub': sub,
+            'mensaje': msg,
+            'wa_link': build_wa_link(sub.client, msg) if sub.platform == 'whatsapp' else None,
+        })
+    return rows
+
+
+# --- COLA DE TRABAJOS ---
+
+JOB_STATUSES = [
+    ('pendiente', 'Pendiente'),
+    ('en_proceso', 'En proceso'),
+    ('hecho', 'Hecho'),
+    ('fallido', 'Fallido'),
+]
+
+# Segundos que un worker puede retener un trabajo antes de que otro lo retome
+JOB_LEASE_SECONDS = 300
+
+
+def enqueue(kind: str, payload: dict = None, run_at: datetime = None, max_attempts: int = 5) -> Job:
+    """Agrega un trabajo a la cola (se guarda en la misma base de datos)."""
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload or {}),
+        run_at=run_at or datetime.now(),
+        max_attempts=max_attempts,
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def lease_job(worker_id: str, lease_seconds: int = JOB_LEASE_SECONDS):
+    """Reserva el próximo trabajo disponible para este worker, o None si no hay.
+
+    Un trabajo está disponible si está pendiente y ya llegó su hora, o si otro
+    worker lo tenía reservado pero su plazo venció (se cayó a mitad de camino).
+    La reserva es un UPDATE condicional, así dos workers nunca toman el mismo.
+    """
+    now = datetime.now()
+
+    # Los que agotaron sus intentos y quedaron colgados pasan a fallidos
+    db.session.execute(
+        update(Job)
+        .where(Job.status == 'en_proceso',
+               Job.locked_until < now,
+               Job.attempts >= Job.max_attempts)
+        .values(status='fallido', finished_at=now,
+                last_error='El worker no terminó a tiempo y se agotaron los intentos.')
+    )
+    db.session.commit()
+
+    disponible = or_(
+        and_(Job.status == 'pendiente', Job.run_at <= now),
+        and_(Job.status == 'en_proceso', Job.locked_until < now),
+    )
+
+    for _ in range(5):
+        job_id = db.session.execute(
+            db.select(Job.id).where(disponible).order_by(Job.run_at.asc()).limit(1)
+        ).scalar()
+        if job_id is None:
+            return None
+
+        result = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, disponible)
+            .values(status='en_proceso',
+                    locked_by=worker_id,
+                    locked_until=now + timedelta(seconds=lease_seconds),
+                    attempts=Job.attempts + 1)
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            job = db.session.get(Job, job_id)
+            # Fuera de las columnas: sobrevive a que el commit expire el objeto
+            job.lease = (worker_id, job.attempts)
+            return job
+        # otro worker lo tomó primero; probamos con el siguiente
+
+    return None
+
+
+class LeaseLost(Exception):
+    """La reserva del trabajo venció y otro worker lo tomó."""
+
+
+def _update_leased(job: Job, **values) -> bool:
+    """UPDATE del trabajo solo si sigue siendo nuestra reserva (mismo worker e intento).
+
+    Un worker lento cuya reserva venció no pisa el resultado del que lo volvió a tomar.
+    """
+    worker_id, attempt = job.lease
+    result = db.session.execute(
+        update(Job)
+        .where(Job.id == job.id, Job.locked_by == worker_id, Job.attempts == attempt)
+        .values(**values)
+    )
+    if result.rowcount != 1:
+        # Lo que el handler dejó pendiente en la sesión tampoco se guarda
+        db.session.rollback()
+        return False
+    db.session.commit()
+    return True
+
+
+def job_checkpoint(job: Job, lease_seconds: int = JOB_LEASE_SECONDS, **progress):
+    """Guarda el avance del trabajo y extiende la reserva.
+
+    Si el worker se cae, el siguiente que lo tome lee job.checkpoint y sigue
+    desde ahí en lugar de empezar de cero. Si la reserva ya no es nuestra lanza
+    LeaseLost para que el handler deje de trabajar.
+    """
+    data = job.checkpoint
+    data.update(progress)
+    if not _update_leased(job, progress=json.dumps(data),
+                          locked_until=datetime.now() + timedelta(seconds=lease_seconds)):
+        raise LeaseLost(job.id)
+
+
+def complete_job(job: Job) -> bool:
+    """Marca el trabajo como hecho. False si la reserva ya era de otro worker."""
+    return _update_leased(job, status='hecho', finished_at=datetime.now(),
+                          locked_by=None, locked_until=None)
+
+
+def fail_job(job: Job, error: str) -> bool:
+    """Marca un intento fallido: reintenta con espera creciente o lo deja como fallido.
+
+    False si la reserva ya era de otro worker (su resultado no se toca).
+    """
+    attempt = job.lease[1]
+    values = dict(last_error=error, locked_by=None, locked_until=None)
+    if attempt >= job.max_attempts:
+        values.update(status='fallido', finished_at=datetime.now())
+    else:
+        espera = min(30 * 2 ** (attempt - 1), 3600)
+        values.update(status='pendiente', run_at=datetime.now() + timedelta(seconds=espera))
+    return _update_leased(job, **values)
+
+
+def get_state(key: str, default=None):
+    row = db.session.get(AppState, key)
+    return row.value if row else default
+
+
+def set_state(key: str, value):
+    """Guarda un valor en AppState (el commit lo hace quien llama)."""
+    row = db.session.get(AppState, key)
+    if row is None:
+        db.session.add(AppState(key=key, value=str(value)))
+    else:
+        row.value = str(value)
+
+
+def current_engine():
+    """Engine de la base en uso (la del tenant actual o la principal)."""
+    return db.session.get_bind()
+
+
+def reset_engines_after_fork():
+    """Suelta las conexiones heredadas del proceso padre sin cerrarlas."""
+    db.engine.dispose(close=False)
+    tenant_engines.reset(close=False)
+    reporting_engines.reset(close=False)
+
+
+def sqlite_autoincrement(engine, table, archive):
+    """Reconstruye `table` con AUTOINCREMENT si se creó sin él (SQLite no tiene ALTER para eso).
+
+    Copia las filas a una tabla nueva y la renombra; la secuencia arranca
+    después del id más alto entre la tabla y su archivo, así ningún id se
+    vuelve a usar. Los índices los recrea ensure_schema.
+    """
+    with engine.connect() as conn:
+        sql = conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)
+        ).scalar()
+    if not sql or 'AUTOINCREMENT' in sql.upper():
+        return
+
+    ddl = str(CreateTable(table).compile(engine)).strip()
+    ddl = ddl.replace(f'CREATE TABLE {table.name} ', f'CREATE TABLE {table.name}_nueva ', 1)
+    with engine.connect() as conn:
+        existing = [c['name'] for c in db.inspect(conn).get_columns(table.name)]
+        cols = ', '.join(c.name for c in table.columns if c.name in existing)
+        raw = conn.connection.driver_connection
+        conn.commit()
+        foreign_keys = raw.execute('PRAGMA foreign_keys').fetchone()[0]
+        # foreign_keys no se puede cambiar dentro de una transacción
+        raw.executescript(f'''
+            PRAGMA foreign_keys = OFF;
+            BEGIN;
+            {ddl};
+            INSERT INTO {table.name}_nueva ({cols}) SELECT {cols} FROM {table.name};
+            DROP TABLE {table.name};
+            ALTER TABLE {table.name}_nueva RENAME TO {table.name};
+            DELETE FROM sqlite_sequence WHERE name = '{table.name}';
+            INSERT INTO sqlite_sequence (name, seq) SELECT '{table.name}', MAX(
+                COALESCE((SELECT MAX(id) FROM {table.name}), 0),
+                COALESCE((SELECT MAX(id) FROM {archive.name}), 0));
+            COMMIT;
+            PRAGMA foreign_keys = {int(foreign_keys)};
+        ''')
+
+
+def ensure_schema(engine=None):
+    """Crea las tablas que falten y agrega columnas/índices nuevos a bases ya existentes.
+
+    db.create_all() no toca tablas que ya existen, así que las columnas que se
+    agregan a un modelo después se añaden aquí con ALTER TABLE.
+    """
+    engine = engine or current_engine()
+    db.metadata.create_all(engine)
+    if engine.dialect.name == 'sqlite':
+        sqlite_autoincrement(engine, Subscription.__table__, SubscriptionArchive.__table__)
+    inspector = db.inspect(engine)
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=engine.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}')
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def ensure_all_schemas():
+    """ensure_schema en la base principal y en la de cada tenant."""
+    ensure_schema()
+    for name in list_tenants():
+        ensure_schema(tenant_engines.get(name))
+
+
+def exports_dir() -> str:
+    path = os.path.join(app.instance_path, 'exports', current_tenant() or '')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def csv_lines(rows):
+    """Convierte filas en líneas de CSV, una a la vez (para respuestas en streaming)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+# --- CONSULTAS LENTAS ---
+#
+# Cada consulta que tarda más de SLOW_QUERY_MS se agrega como una línea JSON a
+# instance/consultas_lentas.log, que comparten todos los procesos (web,
+# workers, CLI). `flask mantenimiento stats` agrupa las más lentas.
+
+SLOW_QUERY_LOG_BYTES = 5 * 1024 * 1024  # al pasar este tamaño se rota a .1
+
+_slow_log_lock = threading.Lock()
+
+
+def slow_query_log_path() -> str:
+    return os.path.join(app.instance_path, 'consultas_lentas.log')
+
+
+def record_slow_query(statement: str, ms: float):
+    line = json.dumps({
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'ms': round(ms, 1),
+        'tenant': current_tenant(),
+        'sql': ' '.join(statement.split())[:1000],
+    }, ensure_ascii=False)
+    path = slow_query_log_path()
+    with _slow_log_lock:
+        os.makedirs(app.instance_path, exist_ok=True)
+        if os.path.exists(path) and os.path.getsize(path) > SLOW_QUERY_LOG_BYTES:
+            os.replace(path, path + '.1')
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    ms = (time.perf_counter() - conn.info['query_started'].pop()) * 1000
+    threshold = app.config['SLOW_QUERY_MS']
+    if threshold and ms >= threshold:
+        record_slow_query(statement, ms)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _query_failed(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_started'):
+        conn.info['query_started'].pop()
+
+
+# --- BASE DE REPORTES (SOLO LECTURA) ---
+#
+# Panel, reportes, analítica, exportaciones y el notifier leen mucho y por
+# mucho rato; en SQLite esa lectura demora los commits de las ventas. Dentro
+# de `with reporting():` las consultas de db.session van a otro engine: una
+# copia de la base abierta con mode=ro (modo 'snapshot') o una réplica
+# (modo 'replica'). Las escrituras nunca deben ir dentro del bloque.
+
+REPORTING_SNAPSHOT_KEEP = 2  # copias por base que se conservan en disco
+
+SNAPSHOT_NAME_RE = re.compile(r'^(?P<base>.+)-(?P<stamp>\d{8}T\d{6})\.db$')
+
+
+def reporting_dir() -> str:
+    path = app.config['REPORTING_DIR'] or os.path.join(app.instance_path, 'reportes')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def snapshot_base(tenant) -> str:
+    # '_principal' no puede chocar con un tenant (TENANT_NAME_RE no admite '_' al inicio)
+    return tenant or '_principal'
+
+
+def list_snapshots(tenant):
+    """[(fecha, ruta)] de las copias de esa base, de la más vieja a la más nueva."""
+    base = snapshot_base(tenant)
+    found = []
+    for name in os.listdir(reporting_dir()):
+        match = SNAPSHOT_NAME_RE.match(name)
+        if match and match['base'] == base:
+            found.append((datetime.strptime(match['stamp'], '%Y%m%dT%H%M%S'),
+                          os.path.join(reporting_dir(), name)))
+    return sorted(found)
+
+
+def refresh_snapshot() -> dict:
+    """Copia la base actual (SQLite) a un archivo nuevo con la API de backup.
+
+    Se escribe a un .tmp y se renombra, así nadie abre una copia a medias; las
+    más viejas se borran (quien las tenga abiertas las sigue leyendo hasta cerrar).
+    """
+    engine = current_engine()
+    if engine.dialect.name != 'sqlite':
+        raise RuntimeError('Las copias para reportes solo se hacen con SQLite; usa el modo replica.')
+
+    tenant = current_tenant()
+    taken = datetime.now().replace(microsecond=0)
+    path = os.path.join(reporting_dir(), f"{snapshot_base(tenant)}-{taken:%Y%m%dT%H%M%S}.db")
+    t0 = time.perf_counter()
+
+    source = engine.raw_connection()
+    try:
+        target = sqlite3.connect(path + '.tmp')
+        try:
+            source.driver_connection.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    os.replace(path + '.tmp', path)
+
+    for _, old in list_snapshots(tenant)[:-REPORTING_SNAPSHOT_KEEP]:
+        os.remove(old)
+    return {'archivo': path, 'datos_al': taken, 'bytes': os.path.getsize(path),
+            'segundos': round(time.perf_counter() - t0, 2)}
+
+
+def replica_lag_seconds(engine) -> int:
+    """Atraso de una réplica de PostgreSQL (0 si no es réplica u otro motor)."""
+    if engine.dialect.name != 'postgresql':
+        return 0
+    with engine.connect() as conn:
+        lag = conn.exec_driver_sql(
+            'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'
+        ).scalar()
+    return max(0, int(lag or 0))
+
+
+def reporting_source(fresher_than: datetime = None):
+    """(engine, info) para los reportes; engine None = usar la base principal."""
+    mode = app.config['REPORTING_MODE']
+    tenant = current_tenant()
+    now = datetime.now()
+    live = (None, {'modo': 'principal', 'datos_al': now, 'atraso_s': 0})
+
+    if mode == 'snapshot':
+        snapshots = list_snapshots(tenant)
+        if not snapshots:
+            return live
+        taken, path = snapshots[-1]
+        max_stale = timedelta(minutes=app.config['REPORTING_MAX_STALE_MINUTES'])
+        if now - taken > max_stale or (fresher_than and taken < fresher_than):
+            return live
+        # immutable: el archivo nunca cambia (cada copia es un archivo nuevo), SQLite no usa locks
+        engine = reporting_engines.get(f'sqlite:///file:{path}?mode=ro&immutable=1&uri=true')
+        return engine, {'modo': 'snapshot', 'datos_al': taken, 'atraso_s': int((now - taken).total_seconds())}
+
+    if mode == 'replica':
+        url = (app.config['REPORTING_TENANT_DATABASE_URL'].format(tenant=tenant) if tenant
+               else app.config['REPORTING_DATABASE_URL'])
+        if not url:
+            return live
+        engine = reporting_engines.get(url)
+        try:
+            lag = replica_lag_seconds(engine)
+        except SQLAlchemyError:
+            return live  # réplica caída: mejor lento que sin reporte
+        taken = now - timedelta(seconds=lag)
+        if fresher_than and taken < fresher_than:
+            return live
+        return engine, {'modo': 'replica', 'datos_al': taken, 'atraso_s': lag}
+
+    return live
+
+
+@contextmanager
+def reporting(fresher_than: datetime = None):
+    """Manda las consultas del bloque a la base de reportes y devuelve qué tan viejos son los datos.
+
+    La info queda también en g para que la plantilla la muestre. Si no hay
+    modo de reportes, o la copia es más vieja que fresher_than o que
+    REPORTING_MAX_STALE_MINUTES, el bloque lee de la base principal.
+    """
+    if g.get('reporting_engine') is not None:  # bloque anidado
+        yield g.reporting_info
+        return
+
+    engine, info = reporting_source(fresher_than)
+    g.reporting_info = info
+    g.reporting_engine = engine
+    try:
+        yield info
+    finally:
+        g.reporting_engine = None
+
+
+def reporting_json(info) -> dict:
+    return dict(info, datos_al=info['datos_al'].isoformat(timespec='seconds'))
+
+
+def schedule_snapshots(minutes: int = None) -> Job:
+    """Deja un único trabajo que refresca la copia de reportes cada N minutos."""
+    minutes = minutes or app.config['REPORTING_SNAPSHOT_MINUTES']
+    db.session.execute(
+        db.delete(Job).where(Job.kind == 'snapshot_reportes', Job.status == 'pendiente')
+    )
+    return enqueue('snapshot_reportes', {'minutos': minutes, 'repetir': True},
+                   run_at=datetime.now() + timedelta(minutes=minutes), max_attempts=3)
+
+
+# --- CACHÉ DE LISTAS DE REFERENCIA ---
+#
+# Vendedores y cuentas con perfiles libres cambian poco pero se listan en
+# casi todos los formularios. Cada proceso guarda la lista como tuplas junto
+# con la versión que leyó de CacheVersion; como la versión vive en la base,
+# todos los workers de gunicorn ven el mismo cambio apenas se hace commit.
+
+SellerRow = namedtuple('SellerRow', 'id name phone notes commission_pct')
+AccountRow = namedtuple('AccountRow', 'id service user used_slots total_slots')
+
+_list_cache = {}   # (tenant, nombre) -> (versión, filas)
+CACHE_STATS = {}   # nombre -> {'hits': n, 'misses': n} (por proceso)
+
+
+def _load_sellers():
+    return [
+        SellerRow(*row) for row in db.session.execute(
+            db.select(Seller.id, Seller.name, Seller.phone, Seller.notes, Seller.commission_pct)
+            .order_by(Seller.name.asc())
+        )
+    ]
+
+
+def _load_free_accounts():
+    return [
+        AccountRow(*row) for row in db.session.execute(
+            db.select(Account.id, Account.service, Account.user,
+                      Account.used_slots, Account.total_slots)
+            .where(Account.used_slots < Account.total_slots)
+            .order_by(Account.service.asc(), Account.user.asc())
+        )
+    ]
+
+
+CACHED_LISTS = {
+    'sellers': _load_sellers,
+    'accounts_libres': _load_free_accounts,
+}
+
+
+def cached_list(name: str):
+    """Devuelve la lista desde la caché si su versión sigue vigente; si no, la recarga."""
+    version = db.session.execute(
+        db.select(CacheVersion.version).where(CacheVersion.name == name)
+    ).scalar() or 0
+    stats = CACHE_STATS.setdefault(name, {'hits': 0, 'misses': 0})
+
+    key = (current_tenant(), name)
+    entry = _list_cache.get(key)
+    if entry and entry[0] == version:
+        stats['hits'] += 1
+        return entry[1]
+
+    stats['misses'] += 1
+    rows = CACHED_LISTS[name]()
+    _list_cache[key] = (version, rows)
+    return rows
+
+
+def invalidate_cache(*names):
+    """Sube la versión de las listas (el commit lo hace quien llama, junto con el cambio)."""
+    for name in names:
+        result = db.session.execute(
+            update(CacheVersion)
+            .where(CacheVersion.name == name)
+            .values(version=CacheVersion.version + 1)
+        )
+        if result.rowcount == 0:
+            db.session.add(CacheVersion(name=name, version=1))
+
+
+# --- ARCHIVO DE SUSCRIPCIONES (HISTÓRICO) ---
+
+# Meses desde el vencimiento para mover una suscripción al archivo
+ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', '6'))
+
+# Columnas que comparten Subscription y SubscriptionArchive
+HISTORY_COLUMNS = [
+    'id', 'client_id', 'account_id', 'seller_id', 'start_date', 'end_date', 'price',
+    'currency', 'platform', 'payment_status', 'payment_status_changed_at', 'status', 'slot',
+    'renewed_from_id',
+]
+
+
+def months_ago(today: date, months: int) -> date:
+    year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+    month += 1
+    # si el día no existe en ese mes (31 de febrero), usamos el último día
+    return date(year, month, min(today.day, calendar.monthrange(year, month)[1]))
+
+
+def subscription_history():
+    """Subconsulta con las suscripciones operativas y las archivadas juntas.
+
+    Para reportes e historial; las vistas operativas usan solo Subscription.
+    """
+    hot = db.select(
+        *[getattr(Subscription, c) for c in HISTORY_COLUMNS],
+        db.literal(False).label('archived'),
+    )
+    cold = db.select(
+        *[getattr(SubscriptionArchive, c) for c in HISTORY_COLUMNS],
+        db.literal(True).label('archived'),
+    )
+    return db.union_all(hot, cold).subquery('historial')
+
+
+def archive_expired(months: int = ARCHIVE_AFTER_MONTHS, batch_size: int = 1000,
+                    today: date = None, on_batch=None) -> int:
+    """Mueve al archivo, por lotes, las suscripciones vencidas hace más de `months` meses.
+
+    Cada lote es una transacción (copiar + borrar), así que se puede cortar y
+    volver a correr sin perder ni duplicar filas. Devuelve cuántas movió.
+    """
+    cutoff = months_ago(today or date.today(), months)
+    table = Subscription.__table__
+    archive = SubscriptionArchive.__table__
+    cols = [table.c[c] for c in HISTORY_COLUMNS]
+
+    moved = 0
+    while True:
+        ids = [
+            row[0] for row in db.session.execute(
+                db.select(Subscription.id)
+                .where(Subscription.end_date < cutoff)
+                .order_by(Subscription.id.asc())
+                .limit(batch_size)
+            )
+        ]
+        if not ids:
+            break
+
+        db.session.execute(
+            archive.insert().from_select(
+                HISTORY_COLUMNS,
+                db.select(*cols).where(table.c.id.in_(ids))
+            )
+        )
+        db.session.execute(db.delete(NotificationLog).where(NotificationLog.subscription_id.in_(ids)))
+        db.session.execute(db.delete(Subscription).where(Subscription.id.in_(ids)))
+        db.session.commit()
+
+        moved += len(ids)
+        if on_batch:
+            on_batch(moved)
+
+    return moved
+
+
+def has_history(column, value) -> bool:
+    """True si hay suscripciones (operativas o archivadas) con column == value."""
+    for model in (Subscription, SubscriptionArchive):
+        if db.session.execute(
+            db.select(model.id).where(getattr(model, column) == value).limit(1)
+        ).first():
+            return True
+    return False
+
+
+# --- RESUMEN POR CLIENTE ---
+
+def refresh_client_summaries(client_ids, today: date = None):
+    """Recalcula ClientSummary y ClientSpend de esos clientes (el commit lo hace quien llama).
+
+    Son tres GROUP BY acotados a los clientes indicados, así que se puede
+    llamar en cada venta, renovación, edición o borrado sin costo notable.
+    """
+    client_ids = {int(c) for c in client_ids if c}
+    if not client_ids:
+        return
+    today = today or date.today()
+    ids = list(client_ids)
+
+    activas = {
+        client_id: (count, next_expiry)
+        for client_id, count, next_expiry in db.session.execute(
+            db.select(Subscription.client_id, db.func.count(), db.func.min(Subscription.end_date))
+            .where(Subscription.client_id.in_(ids), Subscription.end_date >= today)
+            .group_by(Subscription.client_id)
+        )
+    }
+    # Última compra y gasto histórico incluyen el archivo
+    hist = subscription_history()
+    ultimas = dict(db.session.execute(
+        db.select(hist.c.client_id, db.func.max(hist.c.start_date))
+        .where(hist.c.client_id.in_(ids))
+        .group_by(hist.c.client_id)
+    ).all())
+    gastos = db.session.execute(
+        db.select(hist.c.client_id, hist.c.currency, db.func.sum(hist.c.price))
+        .where(hist.c.client_id.in_(ids))
+        .group_by(hist.c.client_id, hist.c.currency)
+    ).all()
+
+    db.session.execute(db.delete(ClientSpend).where(ClientSpend.client_id.in_(ids)))
+    for client_id, currency, total in gastos:
+        db.session.add(ClientSpend(client_id=client_id, currency=currency, total=total))
+
+    existentes = {
+        s.client_id: s for s in db.session.scalars(
+            db.select(ClientSummary).where(ClientSummary.client_id.in_(ids))
+        )
+    }
+    for client_id in ids:
+        summary = existentes.get(client_id) or ClientSummary(client_id=client_id)
+        count, next_expiry = activas.get(client_id, (0, None))
+        summary.active_count = count
+        summary.next_expiry = next_expiry
+        summary.last_purchase = ultimas.get(client_id)
+        summary.computed_on = today
+        db.session.add(summary)
+
+
+def refresh_stale_summaries(today: date = None) -> int:
+    """Recalcula los resúmenes que el paso de los días dejó viejos; devuelve cuántos.
+
+    Solo cambian solos cuando vence la suscripción más próxima, así que basta
+    con buscar next_expiry < hoy en su índice. Lo corre el mantenimiento de la
+    madrugada (tarea 'resumenes'); /clientes lo repite por si no está programado.
+    """
+    today = today or date.today()
+    stale = [
+        row[0] for row in db.session.execute(
+            db.select(ClientSummary.client_id).where(ClientSummary.next_expiry < today)
+        )
+    ]
+    if stale:
+        refresh_client_summaries(stale, today)
+        db.session.commit()
+    return len(stale)
+
+
+# --- LÍNEA DE VENCIMIENTOS ---
+
+# Máximo de días que se pueden pedir en /api/vencimientos
+MAX_DIAS_VENCIMIENTOS = 365
+
+
+def expiry_timeline(today: date, days: int) -> dict:
+    """Vencimientos por día, servicio y moneda para los próximos `days` días.
+
+    Todo sale de un solo GROUP BY sobre el índice de end_date; no se cargan
+    suscripciones. Los días sin vencimientos también aparecen (en cero).
+    """
+    days = max(1, min(days, MAX_DIAS_VENCIMIENTOS))
+    hasta = today + timedelta(days=days - 1)
+
+    with reporting() as datos:
+        rows = db.session.execute(
+            db.select(
+                Subscription.end_date,
+                Account.service,
+                Subscription.currency,
+                db.func.count(Subscription.id),
+                db.func.sum(Subscription.price),
+            )
+            .join(Account, Subscription.account_id == Account.id)
+            .where(Subscription.end_date >= today, Subscription.end_date <= hasta)
+            .group_by(Subscription.end_date, Account.service, Subscription.currency)
+        ).all()
+
+    buckets = {
+        today + timedelta(days=i): {'cantidad': 0, 'por_moneda': {}, 'por_servicio': {}}
+        for i in range(days)
+    }
+    totales = {'cantidad': 0, 'por_moneda': {}}
+    servicios = set()
+
+    for end_date, service, currency, count, total in rows:
+        bucket = buckets[end_date]
+        bucket['cantidad'] += count
+        bucket['por_moneda'][currency] = bucket['por_moneda'].get(currency, 0) + total
+
+        svc = bucket['por_servicio'].setdefault(service, {'cantidad': 0, 'por_moneda': {}})
+        svc['cantidad'] += count
+        svc['por_moneda'][currency] = svc['por_moneda'].get(currency, 0) + total
+
+        totales['cantidad'] += count
+        totales['por_moneda'][currency] = totales['por_moneda'].get(currency, 0) + total
+        servicios.add(service)
+
+    return {
+        'desde': today,
+        'hasta': hasta,
+        'dias': days,
+        'servicios': sorted(servicios),
+        'buckets': [dict(fecha=d, **b) for d, b in buckets.items()],
+        'totales': totales,
+        'datos': datos,
+    }
+
+
+# --- REPORTE DE VENDEDORES ---
+
+def seller_report(desde: date, hasta: date, commission_pct: float = None) -> dict:
+    """Ventas por vendedor y moneda con inicio entre `desde` y `hasta` (incluidas las archivadas).
+
+    Cada tabla se agrupa por separado usando su índice de ventas, que cubre
+    todas las columnas (no se leen las filas), y después se suman las dos
+    partes. `commission_pct` reemplaza la comisión guardada de cada vendedor.
+    """
+    parts = db.union_all(*[
+        db.select(
+            model.seller_id.label('seller_id'),
+            model.currency.label('currency'),
+            db.func.count().label('ventas'),
+            db.func.count(model.renewed_from_id).label('renovaciones'),
+            db.func.sum(model.price).label('total'),
+        )
+        .where(model.start_date >= desde, model.start_date <= hasta)
+        .group_by(model.seller_id, model.currency)
+        for model in (Subscription, SubscriptionArchive)
+    ]).subquery()
+    with reporting() as datos:
+        rows = db.session.execute(
+            db.select(
+                parts.c.seller_id,
+                parts.c.currency,
+                db.func.sum(parts.c.ventas),
+                db.func.sum(parts.c.renovaciones),
+                db.func.sum(parts.c.total),
+            )
+            .group_by(parts.c.seller_id, parts.c.currency)
+        ).all()
+
+    sellers = {s.id: s for s in cached_list('sellers')}
+    vendedores = {}
+    totales = {}
+
+    for seller_id, currency, ventas, renovaciones, total in rows:
+        seller = sellers.get(seller_id)
+        pct = commission_pct if commission_pct is not None else ((seller.commission_pct or 0) if seller else 0)
+        v = vendedores.setdefault(seller_id, {
+            'id': seller_id,
+            'nombre': seller.name if seller else 'Sin vendedor',
+            'comision_pct': pct,
+            'ventas': 0,
+            'renovaciones': 0,
+            'monedas': [],
+        })
+        v['ventas'] += ventas
+        v['renovaciones'] += renovaciones
+        v['monedas'].append({
+            'moneda': currency,
+            'ventas': ventas,
+            'nuevas': ventas - renovaciones,
+            'renovaciones': renovaciones,
+            'total': round(total, 2),
+            'ticket_promedio': round(total / ventas, 2),
+            'comision': round(total * pct / 100, 2),
+        })
+
+        t = totales.setdefault(currency, {'ventas': 0, 'total': 0.0, 'comision': 0.0})
+        t['ventas'] += ventas
+        t['total'] = round(t['total'] + total, 2)
+        t['comision'] = round(t['comision'] + total * pct / 100, 2)
+
+    for v in vendedores.values():
+        v['monedas'].sort(key=lambda m: m['moneda'])
+
+    return {
+        'desde': desde.isoformat(),
+        'hasta': hasta.isoformat(),
+        'vendedores': sorted(vendedores.values(), key=lambda v: (-v['ventas'], v['nombre'])),
+        'totales': dict(sorted(totales.items())),
+        'datos': reporting_json(datos),
+    }
+
+
+# --- RENOVACIONES ---
+
+# Ventana por defecto (días hacia adelante) del filtro de renovación en lote
+RENOVAR_LOTE_DIAS = 7
+
+# Días después del vencimiento en que una nueva compra todavía cuenta como renovación
+RENOVACION_GRACIA_DIAS = 30
+
+
+def slot_released(sub, today: date) -> bool:
+    """True si el perfil de `sub` ya no cuenta como ocupado.
+
+    Una suscripción retiene su perfil hasta RENOVACION_GRACIA_DIAS después del
+    fin, para que renovarla no necesite uno libre; pasado ese plazo el
+    mantenimiento de perfiles (maintenance.reconcile_slots) lo libera.
+    """
+    return sub.end_date < today - timedelta(days=RENOVACION_GRACIA_DIAS)
+
+
+def has_renewal(sub) -> bool:
+    return db.session.execute(
+        db.select(Subscription.id).where(Subscription.renewed_from_id == sub.id).limit(1)
+    ).first() is not None
+
+
+def holds_slot(sub, today: date) -> bool:
+    """True si `sub` ocupa un perfil: no fue renovada y no pasó la gracia (como maintenance.occupied_slots)."""
+    return not slot_released(sub, today) and not has_renewal(sub)
+
+
+def reserve_slots(account_id: int, n: int = 1) -> bool:
+    """Ocupa `n` perfiles de la cuenta solo si alcanzan (UPDATE condicional, seguro con
+    ventas simultáneas). Devuelve False si no había lugar (el commit lo hace quien llama)."""
+    result = db.session.execute(
+        update(Account.__table__)
+        .where(Account.id == account_id, Account.used_slots + n <= Account.total_slots)
+        .values(used_slots=Account.used_slots + n)
+    )
+    return result.rowcount == 1
+
+
+def renewal_defaults(sub, today: date):
+    """Inicio sugerido y duración por defecto para renovar `sub`.
+
+    La renovación arranca el día siguiente al fin (o hoy, si ya venció) y dura
+    lo mismo que la suscripción anterior.
+    """
+    suggested_start = max(sub.end_date + timedelta(days=1), today)
+    default_days = (sub.end_date - sub.start_date).days or 30
+    return suggested_start, default_days
+
+
+def expiring_subscriptions(today: date, sub_ids=None, days=RENOVAR_LOTE_DIAS,
+                           payment_status='', service='', seller_id=None):
+    """Suscripciones para operaciones en lote (renovación, campañas): las
+    seleccionadas (`sub_ids`) o las que cumplen el filtro y vencen entre hoy y
+    los próximos `days` días. Trae cliente, cuenta y vendedor en la misma consulta."""
+    query = (
+        Subscription.query
+        .join(Account)
+        .options(
+            db.contains_eager(Subscription.account),
+            db.joinedload(Subscription.client),
+            db.joinedload(Subscription.seller),
+        )
+    )
+
+    if sub_ids is not None:
+        query = query.filter(Subscription.id.in_(sub_ids))
+    else:
+        query = query.filter(
+            Subscription.end_date >= today,
+            Subscription.end_date <= today + timedelta(days=days),
+        )
+        if payment_status:
+            query = query.filter(Subscription.payment_status == payment_status)
+        if service:
+            query = query.filter(Account.service == service)
+        if seller_id:
+            query = query.filter(Subscription.seller_id == seller_id)
+
+    return query.order_by(Subscription.end_date, Subscription.id).all()
+
+
+def expiring_filter_args(args) -> dict:
+    """Filtro de expiring_subscriptions leído de los parámetros de la URL."""
+    return {
+        'days': args.get('dias', default=RENOVAR_LOTE_DIAS, type=int),
+        'payment_status': args.get('payment_status', default='', type=str),
+        'service': args.get('servicio', default='', type=str),
+        'seller_id': args.get('seller_id', type=int),
+    }
+
+
+# Mayor entero que aceptan las columnas INTEGER (SQLite y BIGINT de PostgreSQL)
+JSON_INT_MAX = 2 ** 63 - 1
+
+
+def _json_int(value, name, minimum, maximum=JSON_INT_MAX):
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f'`{name}` debe ser un número entero')
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f'`{name}` debe ser un número entero') from None
+    if not minimum <= number <= maximum:
+        raise ValueError(f'`{name}` debe estar entre {minimum} y {maximum}')
+    return number
+
+
+def _json_price(value, name):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f'`{name}` debe ser un número')
+    try:
+        price = float(value)
+    except ValueError:
+        raise ValueError(f'`{name}` debe ser un número') from None
+    if not math.isfinite(price) or price < 0:
+        raise ValueError(f'`{name}` debe ser un número finito y no negativo')
+    return price
+
+
+def _json_choice(value, name, choices):
+    if not isinstance(value, str) or value not in choices:
+        raise ValueError(f'`{name}` desconocido')
+    return value
+
+
+def _json_text(value, name) -> str:
+    """Texto sin espacios en los extremos ('' si falta); acepta números (teléfonos, códigos)."""
+    if value is None:
+        return ''
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise ValueError(f'`{name}` debe ser texto')
+    return str(value).strip()
+
+
+def renewal_batch_args(data) -> dict:
+    """Valida el JSON de la renovación en lote; lanza ValueError con el motivo."""
+    if not isinstance(data, dict):
+        raise ValueError('El cuerpo debe ser un objeto JSON')
+
+    args = {'sub_ids': None, 'filtro': None, 'days': None, 'price': None,
+            'payment_status': _json_choice(data.get('payment_status', 'pagado'), 'payment_status',
+                                           dict(PAY_STATUSES))}
+    if data.get('ids') is not None:
+        if not isinstance(data['ids'], list):
+            raise ValueError('`ids` debe ser una lista')
+        args['sub_ids'] = [_json_int(i, 'ids', 1) for i in data['ids']]
+    else:
+        filtro = data.get('filtro') or {}
+        if not isinstance(filtro, dict):
+            raise ValueError('`filtro` debe ser un objeto')
+        args['filtro'] = {
+            'days': _json_int(filtro.get('dias', RENOVAR_LOTE_DIAS), 'filtro.dias', 0, 366),
+            'payment_status': _json_choice(filtro.get('payment_status') or '', 'filtro.payment_status',
+                                           ('', *dict(PAY_STATUSES))),
+            'service': filtro.get('servicio') or '',
+            'seller_id': (_json_int(filtro['seller_id'], 'filtro.seller_id', 1)
+                          if filtro.get('seller_id') is not None else None),
+        }
+        if not isinstance(args['filtro']['service'], str):
+            raise ValueError('`filtro.servicio` debe ser texto')
+
+    if data.get('dias') is not None:
+        args['days'] = _json_int(data['dias'], 'dias', 1, 3660)
+    if data.get('precio') is not None:
+        args['price'] = _json_price(data['precio'], 'precio')
+    return args
+
+
+def plan_renewals(subs, today: date, days=None, price=None):
+    """Vista previa de la renovación: una fila por suscripción con sus nuevas fechas.
+
+    `days` y `price` reemplazan los valores por defecto si vienen. Se omiten
+    las suscripciones que ya tienen otra posterior del mismo cliente y cuenta,
+    para que repetir el lote no renueve dos veces.
+    """
+    latest = {}
+    client_ids = list({s.client_id for s in subs})
+    if client_ids:
+        for client_id, account_id, end_date in db.session.execute(
+            db.select(Subscription.client_id, Subscription.account_id, db.func.max(Subscription.end_date))
+            .where(Subscription.client_id.in_(client_ids))
+            .group_by(Subscription.client_id, Subscription.account_id)
+        ):
+            latest[(client_id, account_id)] = end_date
+
+    plan = []
+    seen = set()
+    for sub in subs:
+        start_date, default_days = renewal_defaults(sub, today)
+        n_days = days or default_days
+        row = {
+            'sub': sub,
+            'start_date': start_date,
+            'end_date': start_date + timedelta(days=n_days),
+            'days': n_days,
+            'price': sub.price if price is None else price,
+            'estado': 'lista',
+            'motivo': '',
+            'nuevo_id': None,
+        }
+
+        key = (sub.client_id, sub.account_id)
+        if latest.get(key, sub.end_date) > sub.end_date:
+            row.update(estado='omitida', motivo='Ya tiene una suscripción posterior')
+        elif key in seen:
+            row.update(estado='omitida', motivo='Repetida en el lote')
+        seen.add(key)
+        plan.append(row)
+
+    return plan
+
+
+def apply_renewals(plan, payment_status='pagado'):
+    """Inserta de una vez las renovaciones 'lista' del plan (el commit lo hace quien llama).
+
+    Marca cada fila como 'renovada' con el id de la nueva suscripción y
+    refresca el resumen de los clientes tocados. Las que vencieron hace más de
+    la gracia ya no tienen perfil: se vuelve a ocupar uno o quedan 'omitida'.
+    """
+    today = date.today()
+    for row in plan:
+        if row['estado'] == 'lista' and slot_released(row['sub'], today):
+            if not reserve_slots(row['sub'].account_id):
+                row.update(estado='omitida', motivo='La cuenta ya no tiene perfiles libres')
+            else:
+                invalidate_cache('accounts_libres')
+
+    pending = [row for row in plan if row['estado'] == 'lista']
+    if not pending:
+        return 0
+
+    values = [
+        {
+            'client_id': row['sub'].client_id,
+            'account_id': row['sub'].account_id,
+            'seller_id': row['sub'].seller_id,
+            'start_date': row['start_date'],
+            'end_date': row['end_date'],
+            'price': row['price'],
+            'currency': row['sub'].currency,
+            'platform': row['sub'].platform,
+            'payment_status': payment_status,
+            'status': 'activa',
+            'slot': row['sub'].slot,
+            'renewed_from_id': row['sub'].id,
+        }
+        for row in pending
+    ]
+    # El resto conserva su perfil (mismo slot/cliente): no se toca used_slots
+    new_ids = db.session.scalars(
+        db.insert(Subscription).returning(Subscription.id, sort_by_parameter_order=True),
+        values,
+    ).all()
+
+    for row, new_id in zip(pending, new_ids):
+        row.update(estado='renovada', nuevo_id=new_id)
+
+    refresh_client_summaries(row['sub'].client_id for row in pending)
+    return len(pending)
+
+
+def backfill_renewals(grace_days: int = RENOVACION_GRACIA_DIAS, batch_size: int = 1000) -> int:
+    """Completa renewed_from_id en los datos anteriores al vínculo, con una heurística.
+
+    Dentro de cada cliente y cuenta, ordenadas por inicio, una suscripción
+    renueva a la anterior si empieza después que ella y a más tardar
+    `grace_days` días después de su fin. Solo se tocan filas sin vínculo y
+    ninguna suscripción queda renovada dos veces. Devuelve cuántas vinculó.
+    """
+    hist = subscription_history()
+    linked = {
+        row[0] for row in db.session.execute(
+            db.select(hist.c.renewed_from_id).where(hist.c.renewed_from_id.is_not(None))
+        )
+    }
+
+    links = {Subscription: [], SubscriptionArchive: []}
+    prev = None
+    for row in db.session.execute(
+        db.select(
+            hist.c.id, hist.c.client_id, hist.c.account_id, hist.c.start_date,
+            hist.c.end_date, hist.c.renewed_from_id, hist.c.archived,
+        )
+        .order_by(hist.c.client_id, hist.c.account_id, hist.c.start_date, hist.c.id)
+    ):
+        if (row.renewed_from_id is None and prev is not None
+                and (prev.client_id, prev.account_id) == (row.client_id, row.account_id)
+                and prev.id not in linked
+                and prev.start_date < row.start_date <= prev.end_date + timedelta(days=grace_days)):
+            model = SubscriptionArchive if row.archived else Subscription
+            links[model].append({'b_id': row.id, 'b_from': prev.id})
+            linked.add(prev.id)
+        prev = row
+
+    for model, params in links.items():
+        table = model.__table__
+        stmt = (
+            table.update()
+            .where(table.c.id == db.bindparam('b_id'))
+            .values(renewed_from_id=db.bindparam('b_from'))
+        )
+        for i in range(0, len(params), batch_size):
+            db.session.execute(stmt, params[i:i + batch_size])
+            db.session.commit()
+
+    return sum(len(params) for params in links.values())
+
+
+# --- VENTAS EN LOTE ---
+#
+# Bots y canales asociados registran cientos de ventas por petición. Todo el
+# lote se valida con unas pocas consultas por conjuntos (clientes, vendedores
+# y cuentas con IN), los perfiles se reservan en memoria y luego se insertan
+# clientes y suscripciones con un INSERT por tabla, en una sola transacción.
+
+VENTAS_LOTE_MAX_LINEAS = 5000
+
+
+class SlotsChanged(Exception):
+    """Otra venta ocupó los perfiles reservados mientras se registraba el lote."""
+
+
+def _sale_error(row, motivo):
+    row.update(estado='rechazada', motivo=motivo)
+    for linea in row['lineas']:
+        if linea['estado'] == 'lista':
+            linea['estado'] = 'omitida'
+
+
+def _parse_sale(idx: int, data, today: date) -> dict:
+    """Normaliza una venta del JSON; si algo no es válido la deja 'rechazada'."""
+    row = {
+        'indice': idx, 'ref': None, 'estado': 'lista', 'motivo': None,
+        'client_id': None, 'cliente': None, 'lineas': [],
+    }
+    if not isinstance(data, dict):
+        _sale_error(row, 'La venta debe ser un objeto')
+        return row
+    row['ref'] = data.get('ref')
+
+    try:
+        row['seller_id'] = _json_int(data['seller_id'], 'seller_id', 1)
+        row['start_date'] = date.fromisoformat(data['inicio']) if data.get('inicio') else today
+        days = _json_int(data.get('dias', 30), 'dias', 1, 3660)
+        row['end_date'] = row['start_date'] + timedelta(days=days)
+        if data.get('client_id') is not None:
+            row['client_id'] = _json_int(data['client_id'], 'client_id', 1)
+        lineas = [
+            {
+                'account_id': _json_int(linea['account_id'], 'account_id', 1),
+                'price': _json_price(linea.get('precio') or 0, 'precio'),
+                'currency': _json_choice(linea.get('moneda') or 'BOB', 'moneda', dict(CURRENCIES)),
+                'slot': _json_text(linea.get('slot'), 'slot'),
+                'estado': 'lista', 'motivo': None, 'sub_id': None,
+            }
+            for linea in data.get('lineas') or []
+        ]
+        row['platform'] = _json_choice(data.get('plataforma', 'whatsapp'), 'plataforma', dict(PLATFORMS))
+        row['payment_status'] = _json_choice(data.get('payment_status', 'pagado'), 'payment_status',
+                                             dict(PAY_STATUSES))
+
+        if row['client_id'] is None:
+            cliente = data.get('cliente') or {}
+            if not isinstance(cliente, dict):
+                raise ValueError('`cliente` debe ser un objeto')
+            row['cliente'] = {
+                'name': _json_text(cliente.get('nombre'), 'cliente.nombre'),
+                'country_code': _json_text(cliente.get('codigo_pais'), 'cliente.codigo_pais') or None,
+                'phone': _json_text(cliente.get('telefono'), 'cliente.telefono'),
+                'email': _json_text(cliente.get('email'), 'cliente.email') or None,
+                'notes': _json_text(cliente.get('notas'), 'cliente.notas'),
+            }
+    except (KeyError, TypeError, ValueError, AttributeError, OverflowError) as exc:
+        _sale_error(row, f'Dato inválido o faltante: {exc}')
+        return row
+
+    row['lineas'] = lineas
+    if row['cliente'] is not None and not row['cliente']['name']:
+        _sale_error(row, 'Falta client_id o el nombre del cliente nuevo')
+    elif not lineas:
+        _sale_error(row, 'La venta no tiene líneas')
+    return row
+
+
+def plan_sales(sales, today: date) -> list:
+    """Valida el lote y reserva perfiles libres, con una consulta por tabla para todo el lote.
+
+    Las líneas sin perfil libre quedan 'sin_perfil' (como en nueva_venta);
+    una venta sin ninguna línea reservada queda 'rechazada'.
+    """
+    plan = [_parse_sale(idx, data, today) for idx, data in enumerate(sales)]
+    valid = [row for row in plan if row['estado'] == 'lista']
+
+    client_ids = {row['client_id'] for row in valid if row['client_id'] is not None}
+    known_clients = set(db.session.scalars(
+        db.select(Client.id).where(Client.id.in_(client_ids))
+    )) if client_ids else set()
+    known_sellers = {s.id for s in cached_list('sellers')}
+
+    account_ids = {linea['account_id'] for row in valid for linea in row['lineas']}
+    free = {
+        account_id: (total or 0) - (used or 0)
+        for account_id, used, total in db.session.execute(
+            db.select(Account.id, Account.used_slots, Account.total_slots)
+            .where(Account.id.in_(account_ids))
+        )
+    } if account_ids else {}
+
+    for row in valid:
+        if row['client_id'] is not None and row['client_id'] not in known_clients:
+            _sale_error(row, f"No existe el cliente {row['client_id']}")
+            continue
+        if row['seller_id'] not in known_sellers:
+            _sale_error(row, f"No existe el vendedor {row['seller_id']}")
+            continue
+
+        for linea in row['lineas']:
+            account_id = linea['account_id']
+            if account_id not in free:
+                linea.update(estado='no_encontrada', motivo=f'No existe la cuenta {account_id}')
+            elif free[account_id] <= 0:
+                linea.update(estado='sin_perfil', motivo='La cuenta ya no tiene perfiles disponibles')
+            else:
+                free[account_id] -= 1
+
+        if not any(linea['estado'] == 'lista' for linea in row['lineas']):
+            _sale_error(row, 'Ninguna línea tiene perfiles disponibles')
+    return plan
+
+
+def apply_sales(plan) -> int:
+    """Inserta clientes nuevos y suscripciones de las ventas 'lista' (el commit lo hace quien llama).
+
+    Los perfiles se descuentan con un UPDATE condicional por cuenta, uno a la
+    vez para que rowcount sea confiable en todos los drivers; si otra petición
+    ocupó los mismos perfiles entretanto, lanza SlotsChanged y quien llama
+    debe hacer rollback.
+    """
+    ready = [row for row in plan if row['estado'] == 'lista']
+    if not ready:
+        return 0
+
+    new_clients = [row for row in ready if row['client_id'] is None]
+    if new_clients:
+        ids = db.session.scalars(
+            db.insert(Client).returning(Client.id, sort_by_parameter_order=True),
+            [row['cliente'] for row in new_clients],
+        ).all()
+        for row, client_id in zip(new_clients, ids):
+            row['client_id'] = client_id
+
+    lines = [(row, linea) for row in ready for linea in row['lineas'] if linea['estado'] == 'lista']
+
+    reserved = {}
+    for _, linea in lines:
+        reserved[linea['account_id']] = reserved.get(linea['account_id'], 0) + 1
+    for account_id, n in reserved.items():
+        if not reserve_slots(account_id, n):
+            raise SlotsChanged()
+
+    sub_ids = db.session.scalars(
+        db.insert(Subscription).returning(Subscription.id, sort_by_parameter_order=True),
+        [
+            {
+                'client_id': row['client_id'],
+                'account_id': linea['account_id'],
+                'seller_id': row['seller_id'],
+                'start_date': row['start_date'],
+                'end_date': row['end_date'],
+                'price': linea['price'],
+                'currency': linea['currency'],
+                'platform': row['platform'],
+                'payment_status': row['payment_status'],
+                'status': 'activa',
+                'slot': linea['slot'],
+            }
+            for row, linea in lines
+        ],
+    ).all()
+    for (_, linea), sub_id in zip(lines, sub_ids):
+        linea.update(estado='registrada', sub_id=sub_id)
+    for row in ready:
+        row['estado'] = 'registrada'
+
+    invalidate_cache('accounts_libres')
+    refresh_client_summaries(row['client_id'] for row in ready)
+    return len(sub_ids)
+
+
+def sale_result(row) -> dict:
+    """Fila del plan de ventas en formato JSON."""
+    return {
+        'indice': row['indice'],
+        'ref': row['ref'],
+        'estado': row['estado'],
+        'motivo': row['motivo'],
+        'client_id': row['client_id'],
+        'cliente_nuevo': row['cliente'] is not None,
+        'lineas': [
+            {key: linea[key] for key in ('account_id', 'estado', 'motivo', 'sub_id')}
+            for linea in row['lineas']
+        ],
+    }
+
+
+# --- LISTADOS EN STREAMING ---
+#
+# Las listas largas (ventas, clientes) se mandan a medida que se generan: la
+# plantilla recorre un generador que lee la consulta por bloques desde el
+# cursor, así el primer byte sale enseguida y la memoria no crece con el
+# resultado.
+
+# Filas leídas del cursor por bloque
+STREAM_CHUNK_ROWS = 500
+
+# Bytes de HTML que se juntan antes de mandar cada pedazo
+STREAM_BUFFER_BYTES = 16 * 1024
+
+
+def stream_rows(stmt, on_chunk=None, chunk_size: int = STREAM_CHUNK_ROWS):
+    """Genera las filas de `stmt` de a bloques (yield_per).
+
+    `on_chunk(filas)` puede transformar cada bloque, por ejemplo para traer
+    datos relacionados con una consulta por bloque en lugar de una por fila.
+    """
+    result = db.session.execute(stmt.execution_options(yield_per=chunk_size))
+    for rows in result.partitions():
+        yield from (on_chunk(rows) if on_chunk else rows)
+
+
+def stream_page(template_name: str, **context) -> Response:
+    """Como render_template, pero manda el HTML por pedazos mientras se genera."""
+    def buffered(parts):
+        pending, size = [], 0
+        for part in parts:
+            pending.append(part)
+            size += len(part)
+            if size >= STREAM_BUFFER_BYTES:
+                yield ''.join(pending)
+                pending, size = [], 0
+        if pending:
+            yield ''.join(pending)
+
+    return Response(buffered(stream_template(template_name, **context)), mimetype='text/html')
+
+
 # --- RUTAS BÁSICAS / PANEL ---
 
 @app.route('/test')
@@ -196,44 +1936,46 @@ def index():
     today = datetime.today().date()
     soon = today + timedelta(days=3)
 
-    # Suscripciones activas y por vencer
-    active_subs = Subscription.query.filter(
-        Subscription.end_date >= today
-    ).order_by(Subscription.end_date.asc()).all()
-
-    expiring_subs = Subscription.query.filter(
-        Subscription.end_date >= today,
-        Subscription.end_date <= soon
-    ).order_by(Subscription.end_date.asc()).all()
-
-    # Ventas del mes actual (filtrado en Python para evitar líos de fechas)
-    all_subs = Subscription.query.all()
-    month_subs = [
-        s for s in all_subs
-        if s.start_date
-        and s.start_date.year == today.year
-        and s.start_date.month == today.month
-    ]
+    # Suscripciones activas y por vencer. Filas planas con lo que muestra la
+    # plantilla: objetos del ORM harían cargas perezosas contra la base principal
+    # al salir del bloque, y compartirían el mapa de identidad con ella.
+    with reporting():
+        active_subs = db.session.execute(
+            db.select(
+                Subscription.id, Subscription.end_date, Subscription.payment_status,
+                Client.name.label('client_name'), Account.service,
+            )
+            .join(Client, Subscription.client_id == Client.id)
+            .join(Account, Subscription.account_id == Account.id)
+            .where(Subscription.end_date >= today)
+            .order_by(Subscription.end_date.asc())
+        ).all()
 
-    # Totales globales por moneda
-    total_por_moneda = {}
-    # Totales por vendedor y moneda
-    totales_vendedor = {}
+    expiring_subs = [s for s in active_subs if s.end_date <= soon]
 
-    for s in month_subs:
-        cur = s.currency or 'BOB'
-        total_por_moneda[cur] = total_por_moneda.get(cur, 0) + s.price
+    # Ventas del mes actual, agrupadas en SQL
+    month_start = today.replace(day=1)
+    month_end = today.replace(day=calendar.monthrange(today.year, today.month)[1])
+    reporte = seller_report(month_start, month_end)
 
-        seller_name = s.seller.name if getattr(s, "seller", None) else 'Sin vendedor'
-        if seller_name not in totales_vendedor:
-            totales_vendedor[seller_name] = {}
-        totales_vendedor[seller_name][cur] = (
-            totales_vendedor[seller_name].get(cur, 0) + s.price
-        )
+    # Totales globales por moneda
+    total_por_moneda = {code: t['total'] for code, t in reporte['totales'].items()}
+    # Totales por vendedor y moneda
+    totales_vendedor = {
+        v['nombre']: {m['moneda']: m['total'] for m in v['monedas']}
+        for v in reporte['vendedores']
+    }
 
     activas_count = len(active_subs)
     por_vencer_count = len(expiring_subs)
 
+    dias_timeline = request.args.get('dias', default=30, type=int)
+    timeline = expiry_timeline(today, dias_timeline)
+    max_bucket = max((b['cantidad'] for b in timeline['buckets']), default=0)
+
+    from forecast import cached_forecast
+    pronostico = cached_forecast(today)
+
     return render_template(
         'index.html',
         active_subs=active_subs,
@@ -244,27 +1986,97 @@ def index():
         total_por_moneda=total_por_moneda,
         totales_vendedor=totales_vendedor,
         currencies=CURRENCIES,
+        timeline=timeline,
+        max_bucket=max_bucket,
+        pronostico=pronostico,
     )
 
 
+@app.route('/api/vencimientos')
+def api_vencimientos():
+    today = datetime.today().date()
+    days = request.args.get('days', default=30, type=int)
+    timeline = expiry_timeline(today, days)
+
+    return jsonify({
+        'desde': timeline['desde'].isoformat(),
+        'hasta': timeline['hasta'].isoformat(),
+        'dias': timeline['dias'],
+        'servicios': timeline['servicios'],
+        'totales': timeline['totales'],
+        'buckets': [
+            dict(b, fecha=b['fecha'].isoformat()) for b in timeline['buckets']
+        ],
+        'datos': reporting_json(timeline['datos']),
+    })
+
+
 # ---- CLIENTES ----
 
+CLIENT_ORDERS = [
+    ('nombre', 'Nombre'),
+    ('valor', 'Mayor gasto'),
+    ('vencimiento', 'Próximo vencimiento'),
+    ('compra', 'Última compra'),
+]
+
+
 @app.route('/clientes')
 def clientes():
     q = request.args.get('q', '', type=str)
-    query = Client.query
+    orden = request.args.get('orden', default='nombre', type=str)
+    moneda = request.args.get('moneda', default='BOB', type=str)
+
+    try:
+        refresh_stale_summaries()
+    except SQLAlchemyError:
+        # Base ocupada o de solo lectura: se muestran los resúmenes como están
+        db.session.rollback()
+
+    query = db.select(Client, ClientSummary).outerjoin(
+        ClientSummary, ClientSummary.client_id == Client.id
+    )
 
     if q:
         like = f"%{q}%"
-        query = query.filter(
+        query = query.where(
             db.or_(
                 Client.name.ilike(like),
                 Client.phone.ilike(like)
             )
         )
 
-    clients = query.order_by(Client.name.asc()).all()
-    return render_template('clientes.html', clients=clients)
+    if orden == 'valor':
+        query = query.outerjoin(
+            ClientSpend,
+            and_(ClientSpend.client_id == Client.id, ClientSpend.currency == moneda)
+        ).order_by(ClientSpend.total.desc().nulls_last(), Client.name.asc())
+    elif orden == 'vencimiento':
+        query = query.order_by(ClientSummary.next_expiry.asc().nulls_last(), Client.name.asc())
+    elif orden == 'compra':
+        query = query.order_by(ClientSummary.last_purchase.desc().nulls_last(), Client.name.asc())
+    else:
+        query = query.order_by(Client.name.asc())
+
+    def with_spend(rows):
+        # Gasto por moneda de los clientes del bloque, en una sola consulta
+        gastos = {}
+        for client_id, currency, total in db.session.execute(
+            db.select(ClientSpend.client_id, ClientSpend.currency, ClientSpend.total)
+            .where(ClientSpend.client_id.in_([c.id for c, _ in rows]))
+            .order_by(ClientSpend.currency.asc())
+        ):
+            gastos.setdefault(client_id, {})[currency] = total
+        return [(c, summary, gastos.get(c.id, {})) for c, summary in rows]
+
+    return stream_page(
+        'clientes.html',
+        rows=stream_rows(query, on_chunk=with_spend),
+        orden=orden,
+        moneda=moneda,
+        client_orders=CLIENT_ORDERS,
+        currencies=CURRENCIES,
+    )
 
 
 
@@ -313,14 +2125,35 @@ from datetime import date  # Asegúrate de tener esto arriba (ya lo tienes casi
 @app.route('/clientes/<int:client_id>')
 def detalle_cliente(client_id):
     client = Client.query.get_or_404(client_id)
-    subs = (
-        Subscription.query
+    # Historial completo: operativas + archivadas
+    subs = sorted(
+        Subscription.query.filter_by(client_id=client.id).all()
+        + SubscriptionArchive.query.filter_by(client_id=client.id).all(),
+        key=lambda s: s.end_date,
+        reverse=True,
+    )
+    today = date.today()
+
+    summary = client.summary
+    if summary is None or (summary.next_expiry is not None and summary.next_expiry < today):
+        refresh_client_summaries([client.id], today)
+        db.session.commit()
+        summary = client.summary
+
+    gastos = (
+        ClientSpend.query
         .filter_by(client_id=client.id)
-        .order_by(Subscription.end_date.desc())
+        .order_by(ClientSpend.currency.asc())
         .all()
     )
-    today = date.today()
-    return render_template('cliente_detalle.html', client=client, subs=subs, today=today)
+    return render_template(
+        'cliente_detalle.html',
+        client=client,
+        subs=subs,
+        today=today,
+        summary=summary,
+        gastos=gastos,
+    )
 
 
 
@@ -328,11 +2161,13 @@ def detalle_cliente(client_id):
 def eliminar_cliente(client_id):
     client = Client.query.get_or_404(client_id)
 
-    tiene_ventas = Subscription.query.filter_by(client_id=client.id).count() > 0
+    tiene_ventas = has_history('client_id', client.id)
     if tiene_ventas:
         flash('No puedes eliminar este cliente porque tiene suscripciones registradas.', 'danger')
         return redirect(url_for('clientes'))
 
+    ClientSpend.query.filter_by(client_id=client.id).delete()
+    ClientSummary.query.filter_by(client_id=client.id).delete()
     db.session.delete(client)
     db.session.commit()
     flash('Cliente eliminado correctamente.', 'success')
@@ -343,7 +2178,7 @@ def eliminar_cliente(client_id):
 
 @app.route('/vendedores')
 def vendedores():
-    sellers = Seller.query.order_by(Seller.name.asc()).all()
+    sellers = cached_list('sellers')
     return render_template('vendedores.html', sellers=sellers)
 
 
@@ -353,9 +2188,11 @@ def nuevo_vendedor():
         name = request.form['name']
         phone = request.form['phone']
         notes = request.form['notes']
+        commission_pct = request.form.get('commission_pct', type=float) or 0
 
-        nuevo = Seller(name=name, phone=phone, notes=notes)
+        nuevo = Seller(name=name, phone=phone, notes=notes, commission_pct=commission_pct)
         db.session.add(nuevo)
+        invalidate_cache('sellers')
         db.session.commit()
         flash('Vendedor creado correctamente', 'success')
         return redirect(url_for('vendedores'))
@@ -363,16 +2200,101 @@ def nuevo_vendedor():
     return render_template('nuevo_vendedor.html')
 
 
+@app.route('/vendedores/comision/<int:seller_id>', methods=['POST'])
+def comision_vendedor(seller_id):
+    seller = Seller.query.get_or_404(seller_id)
+    seller.commission_pct = request.form.get('commission_pct', type=float) or 0
+    invalidate_cache('sellers')
+    db.session.commit()
+    flash(f'Comisión de {seller.name} actualizada.', 'success')
+    return redirect(request.referrer or url_for('vendedores'))
+
+
+def report_range(args):
+    """Rango (desde, hasta) de los parámetros; por defecto, el mes en curso."""
+    today = datetime.today().date()
+    desde = args.get('desde', type=date.fromisoformat) or today.replace(day=1)
+    hasta = args.get('hasta', type=date.fromisoformat) or today
+    return desde, max(desde, hasta)
+
+
+@app.route('/vendedores/reporte')
+def reporte_vendedores():
+    desde, hasta = report_range(request.args)
+    comision = request.args.get('comision', type=float)
+    reporte = seller_report(desde, hasta, comision)
+
+    if request.args.get('formato') == 'json':
+        return jsonify(reporte)
+
+    return render_template('reporte_vendedores.html', reporte=reporte, comision=comision)
+
+
+@app.route('/vendedores/reporte.csv')
+def reporte_vendedores_csv():
+    """Exporta el reporte; con detalle=1 va venta por venta (en streaming, por lotes)."""
+    desde, hasta = report_range(request.args)
+    comision = request.args.get('comision', type=float)
+    nombre = f'vendedores-{desde.isoformat()}-{hasta.isoformat()}.csv'
+
+    def resumen():
+        yield [
+            'vendedor', 'moneda', 'ventas', 'nuevas', 'renovaciones',
+            'total', 'ticket_promedio', 'comision_pct', 'comision',
+        ]
+        for v in seller_report(desde, hasta, comision)['vendedores']:
+            for m in v['monedas']:
+                yield [
+                    v['nombre'], m['moneda'], m['ventas'], m['nuevas'], m['renovaciones'],
+                    m['total'], m['ticket_promedio'], v['comision_pct'], m['comision'],
+                ]
+
+    def detalle():
+        pcts = {s.id: s.commission_pct or 0 for s in cached_list('sellers')}
+        yield [
+            'id', 'fecha', 'vendedor', 'cliente', 'servicio', 'moneda', 'precio',
+            'renovacion', 'comision_pct', 'comision',
+        ]
+        hist = subscription_history()
+        with reporting():
+            result = db.session.execute(
+                db.select(
+                    hist.c.id, hist.c.start_date, hist.c.seller_id, Seller.name, Client.name,
+                    Account.service, hist.c.currency, hist.c.price, hist.c.renewed_from_id,
+                )
+                .join(Client, hist.c.client_id == Client.id)
+                .join(Account, hist.c.account_id == Account.id)
+                .outerjoin(Seller, hist.c.seller_id == Seller.id)
+                .where(hist.c.start_date >= desde, hist.c.start_date <= hasta)
+                .order_by(hist.c.seller_id, hist.c.start_date, hist.c.id)
+                .execution_options(yield_per=1000)
+            )
+        for sub_id, start, seller_id, seller, client, service, currency, price, renewed_from in result:
+            pct = comision if comision is not None else pcts.get(seller_id, 0)
+            yield [
+                sub_id, start.isoformat(), seller or 'Sin vendedor', client, service, currency,
+                price, 'si' if renewed_from else 'no', pct, round(price * pct / 100, 2),
+            ]
+
+    rows = detalle() if request.args.get('detalle') == '1' else resumen()
+    return Response(
+        stream_with_context(csv_lines(rows)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={nombre}'},
+    )
+
+
 @app.route('/vendedores/eliminar/<int:seller_id>', methods=['POST'])
 def eliminar_vendedor(seller_id):
     seller = Seller.query.get_or_404(seller_id)
 
-    tiene_ventas = Subscription.query.filter_by(seller_id=seller.id).count() > 0
+    tiene_ventas = has_history('seller_id', seller.id)
     if tiene_ventas:
         flash('No puedes eliminar este vendedor porque tiene ventas asociadas.', 'danger')
         return redirect(url_for('vendedores'))
 
     db.session.delete(seller)
+    invalidate_cache('sellers')
     db.session.commit()
     flash('Vendedor eliminado correctamente.', 'success')
     return redirect(url_for('vendedores'))
@@ -414,6 +2336,7 @@ def nueva_cuenta():
             used_slots=0
         )
         db.session.add(nueva)
+        invalidate_cache('accounts_libres')
         db.session.commit()
         flash('Cuenta creada correctamente', 'success')
         return redirect(url_for('cuentas'))
@@ -439,6 +2362,7 @@ def editar_cuenta(account_id):
         if total_slots < 1:
             total_slots = 1
         account.total_slots = total_slots
+        invalidate_cache('accounts_libres')
         db.session.commit()
         flash('Cuenta actualizada correctamente.', 'success')
         return redirect(url_for('cuentas'))
@@ -450,12 +2374,13 @@ def editar_cuenta(account_id):
 def eliminar_cuenta(account_id):
     account = Account.query.get_or_404(account_id)
 
-    tiene_ventas = Subscription.query.filter_by(account_id=account.id).count() > 0
+    tiene_ventas = has_history('account_id', account.id)
     if tiene_ventas:
         flash('No puedes eliminar esta cuenta porque está asociada a suscripciones.', 'danger')
         return redirect(url_for('cuentas'))
 
     db.session.delete(account)
+    invalidate_cache('accounts_libres')
     db.session.commit()
     flash('Cuenta eliminada correctamente.', 'success')
     return redirect(url_for('cuentas'))
@@ -521,18 +2446,28 @@ def ventas():
     payment_status = request.args.get('payment_status', default='', type=str)
     q = request.args.get('q', '', type=str)
 
-    # Hacemos join para poder buscar por cliente y servicio
-    query = Subscription.query.join(Client).join(Account)
+    # Hacemos join para poder buscar por cliente y servicio (y de paso los cargamos)
+    query = (
+        db.select(Subscription)
+        .join(Client)
+        .join(Account)
+        .outerjoin(Seller)
+        .options(
+            db.contains_eager(Subscription.client),
+            db.contains_eager(Subscription.account),
+            db.contains_eager(Subscription.seller),
+        )
+    )
 
     if seller_id:
-        query = query.filter(Subscription.seller_id == seller_id)
+        query = query.where(Subscription.seller_id == seller_id)
     if platform:
-        query = query.filter(Subscription.platform == platform)
+        query = query.where(Subscription.platform == platform)
     if payment_status:
-        query = query.filter(Subscription.payment_status == payment_status)
+        query = query.where(Subscription.payment_status == payment_status)
     if q:
         like = f"%{q}%"
-        query = query.filter(
+        query = query.where(
             or_(
                 Client.name.ilike(like),
                 Account.service.ilike(like),
@@ -540,10 +2475,13 @@ def ventas():
             )
         )
 
-    subs = query.order_by(Subscription.start_date.desc()).all()
-    sellers = Seller.query.order_by(Seller.name.asc()).all()
+    subs = stream_rows(
+        query.order_by(Subscription.start_date.desc()),
+        on_chunk=lambda rows: [sub for sub, in rows],
+    )
+    sellers = cached_list('sellers')
 
-    return render_template(
+    return stream_page(
         'ventas.html',
         subs=subs,
         today=today,
@@ -569,10 +2507,9 @@ def ventas_pendientes():
 @app.route('/ventas/nueva', methods=['GET', 'POST'])
 def nueva_venta():
     # solo cuentas con slots libres
-    accounts = Account.query.filter(Account.used_slots < Account.total_slots) \
-                            .order_by(Account.service.asc(), Account.user.asc()).all()
+    accounts = cached_list('accounts_libres')
     clients = Client.query.order_by(Client.name.asc()).all()
-    sellers = Seller.query.order_by(Seller.name.asc()).all()
+    sellers = cached_list('sellers')
     today = datetime.today().date()
 
     if request.method == 'POST':
@@ -581,8 +2518,9 @@ def nueva_venta():
 
         # ---- CLIENTE EXISTENTE ----
         if client_type == 'existente':
-            client_id = request.form.get('client_id')
-            if not client_id:
+            client_id = request.form.get('client_id', type=int)
+            if (not client_id or not 0 < client_id <= JSON_INT_MAX
+                    or db.session.get(Client, client_id) is None):
                 flash('Selecciona un cliente existente o llena los datos de uno nuevo.', 'danger')
                 return render_template(
                     'nueva_venta.html',
@@ -686,8 +2624,9 @@ def nueva_venta():
 
         lineas = []
         for idx, acc_id in enumerate(account_ids):
-            acc_id = (acc_id or '').strip()
-            if not acc_id:
+            try:
+                acc_id = int(acc_id)
+            except (TypeError, ValueError):
                 continue  # fila vacía, la ignoramos
 
             price_str = (prices[idx] if idx < len(prices) else '').strip()
@@ -722,9 +2661,12 @@ def nueva_venta():
             )
 
         # ---- CREAMOS UNA SUSCRIPCIÓN POR CADA LÍNEA ----
+        cuentas = {
+            a.id: a for a in Account.query.filter(Account.id.in_({l['account_id'] for l in lineas}))
+        }
         creadas = 0
         for linea in lineas:
-            account = Account.query.get(linea['account_id'])
+            account = cuentas.get(linea['account_id'])
             if not account:
                 continue
 
@@ -757,6 +2699,8 @@ def nueva_venta():
             db.session.rollback()
             return redirect(url_for('nueva_venta'))
 
+        invalidate_cache('accounts_libres')
+        refresh_client_summaries([client_id])
         db.session.commit()
         flash(f'Se registraron {creadas} suscripción(es) para el cliente.', 'success')
         return redirect(url_for('ventas'))
@@ -779,7 +2723,7 @@ def nueva_venta():
 @app.route('/ventas/editar/<int:sub_id>', methods=['GET', 'POST'])
 def editar_venta(sub_id):
     sub = Subscription.query.get_or_404(sub_id)
-    sellers = Seller.query.order_by(Seller.name.asc()).all()
+    sellers = cached_list('sellers')
 
     if request.method == 'POST':
         start_date_str = request.form['start_date']
@@ -789,11 +2733,14 @@ def editar_venta(sub_id):
         sub.price = float(request.form['price'])
         sub.currency = request.form['currency']
         sub.platform = request.form['platform']
-        sub.payment_status = request.form['payment_status']
+        if sub.payment_status != request.form['payment_status']:
+            sub.payment_status = request.form['payment_status']
+            sub.payment_status_changed_at = datetime.now()
         sub.slot = request.form['slot']
         seller_id = request.form.get('seller_id')
         if seller_id:
             sub.seller_id = int(seller_id)
+        refresh_client_summaries([sub.client_id])
         db.session.commit()
         flash('Venta / suscripción actualizada correctamente.', 'success')
         return redirect(url_for('ventas'))
@@ -812,6 +2759,11 @@ def editar_venta(sub_id):
 def renovar_venta(sub_id):
     sub = Subscription.query.get_or_404(sub_id)
 
+    # Igual que plan_renewals: renovarla otra vez pondría a dos en el mismo perfil
+    if has_renewal(sub):
+        flash('Esta venta ya fue renovada; renueva la suscripción más reciente.', 'warning')
+        return redirect(url_for('ventas'))
+
     if request.method == 'POST':
         start_date_str = request.form['start_date']
         days = int(request.form['days'])
@@ -821,6 +2773,13 @@ def renovar_venta(sub_id):
         start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
         end_date = start_date + timedelta(days=days)
 
+        # Pasada la gracia el perfil ya se liberó: hay que volver a ocuparlo
+        if slot_released(sub, datetime.today().date()):
+            if not reserve_slots(sub.account_id):
+                flash('La cuenta ya no tiene perfiles libres para renovar esta venta.', 'danger')
+                return redirect(url_for('renovar_venta', sub_id=sub.id))
+            invalidate_cache('accounts_libres')
+
         nueva = Subscription(
             client_id=sub.client_id,
             account_id=sub.account_id,
@@ -832,10 +2791,12 @@ def renovar_venta(sub_id):
             platform=sub.platform,
             payment_status=payment_status,
             status='activa',
-            slot=sub.slot
+            slot=sub.slot,
+            renewed_from_id=sub.id,
         )
         db.session.add(nueva)
-        # NO tocamos used_slots porque es el mismo slot/cliente
+        # Dentro de la gracia conserva su perfil (mismo slot/cliente): no se toca used_slots
+        refresh_client_summaries([sub.client_id])
         db.session.commit()
 
         flash('Renovación registrada correctamente.', 'success')
@@ -843,8 +2804,7 @@ def renovar_venta(sub_id):
 
     # valores por defecto: nueva fecha desde el día siguiente al fin o desde hoy
     today = datetime.today().date()
-    suggested_start = max(sub.end_date + timedelta(days=1), today)
-    default_days = (sub.end_date - sub.start_date).days or 30
+    suggested_start, default_days = renewal_defaults(sub, today)
 
     return render_template(
         'renovar_venta.html',
@@ -855,16 +2815,206 @@ def renovar_venta(sub_id):
     )
 
 
+def renewal_result(row) -> dict:
+    """Fila del plan de renovación en formato JSON."""
+    sub = row['sub']
+    return {
+        'sub_id': sub.id,
+        'cliente': sub.client.name,
+        'servicio': sub.account.service,
+        'fin_actual': sub.end_date.isoformat(),
+        'inicio': row['start_date'].isoformat(),
+        'fin': row['end_date'].isoformat(),
+        'dias': row['days'],
+        'precio': row['price'],
+        'moneda': sub.currency,
+        'estado': row['estado'],
+        'motivo': row['motivo'],
+        'nuevo_id': row['nuevo_id'],
+    }
+
+
+@app.route('/ventas/renovar-lote', methods=['GET', 'POST'])
+def renovar_lote():
+    today = datetime.today().date()
+
+    if request.method == 'POST':
+        sub_ids = request.form.getlist('sub_id[]', type=int)
+        days = request.form.get('dias_suscripcion', type=int)
+        price = request.form.get('precio', type=float)
+        payment_status = request.form.get('payment_status', 'pagado')
+
+        if not sub_ids:
+            flash('Selecciona al menos una suscripción para renovar.', 'warning')
+            return redirect(url_for('renovar_lote'))
+
+        plan = plan_renewals(expiring_subscriptions(today, sub_ids=sub_ids), today, days, price)
+        try:
+            renovadas = apply_renewals(plan, payment_status)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            flash('No se pudo registrar el lote; no se renovó ninguna suscripción.', 'danger')
+            return redirect(url_for('renovar_lote'))
+
+        flash(f'{renovadas} renovaciones registradas.', 'success')
+        return render_template('renovar_lote.html', plan=plan, confirmado=True)
+
+    filtro = expiring_filter_args(request.args)
+    days = request.args.get('dias_suscripcion', type=int)
+    price = request.args.get('precio', type=float)
+
+    plan = plan_renewals(expiring_subscriptions(today, **filtro), today, days, price)
+    services = db.session.scalars(db.select(Account.service).distinct().order_by(Account.service)).all()
+
+    return render_template(
+        'renovar_lote.html',
+        plan=plan,
+        confirmado=False,
+        filtro=filtro,
+        dias_suscripcion=days or '',
+        precio=price if price is not None else '',
+        services=services,
+        sellers=cached_list('sellers'),
+        pay_statuses=PAY_STATUSES,
+    )
+
+
+@app.route('/api/ventas/renovar-lote', methods=['POST'])
+def api_renovar_lote():
+    """Renovación en lote por JSON.
+
+    Recibe `ids` (lista) o `filtro` ({dias, payment_status, servicio, seller_id}),
+    y opcionalmente `dias`, `precio` y `payment_status` de las renovaciones.
+    Sin `confirmar: true` solo devuelve la vista previa.
+    """
+    data = request.get_json(silent=True)
+    try:
+        args = renewal_batch_args(data)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    today = datetime.today().date()
+
+    sub_ids = args['sub_ids']
+    if sub_ids is not None:
+        subs = expiring_subscriptions(today, sub_ids=sub_ids)
+    else:
+        subs = expiring_subscriptions(today, **args['filtro'])
+
+    plan = plan_renewals(subs, today, args['days'], args['price'])
+    confirmar = bool(data.get('confirmar'))
+
+    if confirmar:
+        try:
+            apply_renewals(plan, args['payment_status'])
+            db.session.commit()
+        except SQLAlchemyError as exc:
+            db.session.rollback()
+            return jsonify({'error': f'No se pudo registrar el lote: {exc.__class__.__name__}'}), 500
+
+    resultados = [renewal_result(row) for row in plan]
+    if sub_ids is not None:
+        found = {row['sub'].id for row in plan}
+        resultados += [
+            {'sub_id': i, 'estado': 'no_encontrada', 'motivo': 'No existe la suscripción'}
+            for i in sub_ids if i not in found
+        ]
+
+    return jsonify({
+        'confirmado': confirmar,
+        'renovadas': sum(1 for row in plan if row['estado'] == 'renovada'),
+        'resultados': resultados,
+    })
+
+
+@app.route('/api/ventas/lote', methods=['POST'])
+def api_ventas_lote():
+    """Registra muchas ventas en una sola transacción.
+
+    Recibe `ventas`: lista de {ref, client_id | cliente {nombre, telefono,
+    codigo_pais, email, notas}, seller_id, inicio, dias, plataforma,
+    payment_status, lineas [{account_id, precio, moneda, slot}]} y devuelve
+    el resultado de cada venta y de cada línea.
+    """
+    data = request.get_json(silent=True)
+    sales = data.get('ventas') if isinstance(data, dict) else None
+    if not isinstance(sales, list) or not sales:
+        return jsonify({'error': 'Envía una lista `ventas` con al menos una venta.'}), 400
+    bad = [idx for idx, s in enumerate(sales)
+           if isinstance(s, dict) and not isinstance(s.get('lineas') or [], list)]
+    if bad:
+        return jsonify({'error': f'`lineas` debe ser una lista (ventas {bad[:10]}).'}), 400
+
+    total_lines = sum(len(s.get('lineas') or []) for s in sales if isinstance(s, dict))
+    if total_lines > VENTAS_LOTE_MAX_LINEAS:
+        return jsonify({'error': f'Máximo {VENTAS_LOTE_MAX_LINEAS} líneas por lote (llegaron {total_lines}).'}), 413
+
+    plan = plan_sales(sales, datetime.today().date())
+    try:
+        creadas = apply_sales(plan)
+        db.session.commit()
+    except SlotsChanged:
+        db.session.rollback()
+        return jsonify({'error': 'Otra venta ocupó los mismos perfiles; reintenta el lote.'}), 409
+    except SQLAlchemyError as exc:
+        db.session.rollback()
+        return jsonify({'error': f'No se pudo registrar el lote: {exc.__class__.__name__}'}), 500
+
+    return jsonify({
+        'registradas': sum(1 for row in plan if row['estado'] == 'registrada'),
+        'rechazadas': sum(1 for row in plan if row['estado'] == 'rechazada'),
+        'suscripciones': creadas,
+        'resultados': [sale_result(row) for row in plan],
+    })
+
+
+@app.route('/analitica')
+def analitica():
+    from analytics import build_report, COHORTE_MESES
+    months = max(1, min(request.args.get('meses', default=COHORTE_MESES, type=int), 36))
+    report = build_report(datetime.today().date(), months)
+    return render_template('analitica.html', report=report)
+
+
+@app.route('/api/analitica')
+def api_analitica():
+    from analytics import build_report, COHORTE_MESES
+    months = max(1, min(request.args.get('meses', default=COHORTE_MESES, type=int), 36))
+    report = build_report(datetime.today().date(), months)
+    return jsonify(dict(report, datos=reporting_json(g.reporting_info)))
+
+
+@app.route('/pronostico')
+def pronostico():
+    from forecast import cached_forecast
+    report = cached_forecast(datetime.today().date(), refresh=request.args.get('refrescar') == '1')
+    return render_template('pronostico.html', report=report)
+
+
+@app.route('/api/pronostico')
+def api_pronostico():
+    from forecast import cached_forecast
+    return jsonify(cached_forecast(datetime.today().date(), refresh=request.args.get('refrescar') == '1'))
+
+
 @app.route('/ventas/eliminar/<int:sub_id>', methods=['POST'])
 def eliminar_venta(sub_id):
     sub = Subscription.query.get_or_404(sub_id)
     account = sub.account
+    today = datetime.today().date()
 
-    # liberar 1 slot
-    if account and account.used_slots > 0:
+    # liberar 1 slot, solo si esta venta lo ocupaba; si era la renovación de
+    # otra todavía en gracia, el perfil vuelve a ser de aquella
+    previous = db.session.get(Subscription, sub.renewed_from_id) if sub.renewed_from_id else None
+    if (holds_slot(sub, today) and not (previous and not slot_released(previous, today))
+            and account and account.used_slots > 0):
         account.used_slots -= 1
 
+    client_id = sub.client_id
+    db.session.execute(db.delete(NotificationLog).where(NotificationLog.subscription_id == sub.id))
     db.session.delete(sub)
+    invalidate_cache('accounts_libres')
+    refresh_client_summaries([client_id])
     db.session.commit()
     flash('Suscripción / venta eliminada correctamente.', 'success')
     return redirect(url_for('ventas'))
@@ -908,9 +3058,456 @@ def mensaje_pago(sub_id):
     return render_template('mensaje.html', sub=sub, msg=msg, tipo='Pago', wa_link=wa_link)
 
 
+@app.route('/mensajes/campana')
+def campana():
+    today = datetime.today().date()
+    tipo = request.args.get('tipo', default='recordatorio', type=str)
+    if tipo not in dict(CAMPAIGN_KINDS):
+        tipo = 'recordatorio'
+    filtro = expiring_filter_args(request.args)
+
+    rows = campaign_messages(tipo, expiring_subscriptions(today, **filtro), today)
+    services = db.session.scalars(db.select(Account.service).distinct().order_by(Account.service)).all()
+
+    return render_template(
+        'campana.html',
+        rows=rows,
+        tipo=tipo,
+        filtro=filtro,
+        con_enlace=sum(1 for r in rows if r['wa_link']),
+        campaign_kinds=CAMPAIGN_KINDS,
+        services=services,
+        sellers=cached_list('sellers'),
+        pay_statuses=PAY_STATUSES,
+        today=today,
+    )
+
+
+@app.route('/mensajes/campana.csv')
+def campana_csv():
+    today = datetime.today().date()
+    tipo = request.args.get('tipo', default='recordatorio', type=str)
+    if tipo not in dict(CAMPAIGN_KINDS):
+        tipo = 'recordatorio'
+
+    subs = expiring_subscriptions(today, **expiring_filter_args(request.args))
+    # Filas armadas antes de responder: el generador corre con la sesión ya cerrada
+    lines = [
+        [
+            r['sub'].id, r['sub'].client.name, build_wa_number(r['sub'].client) or '',
+            r['sub'].account.service, r['sub'].end_date.isoformat(), r['sub'].payment_status,
+            r['sub'].seller.name if r['sub'].seller else '', r['sub'].platform,
+            r['wa_link'] or '', r['mensaje'],
+        ]
+        for r in campaign_messages(tipo, subs, today)
+    ]
+
+    header = [
+        'id', 'cliente', 'telefono', 'servicio', 'fin', 'estado_pago',
+        'vendedor', 'plataforma', 'enlace', 'mensaje',
+    ]
+
+    return Response(
+        csv_lines([header] + lines),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename=campana-{tipo}-{today.isoformat()}.csv'},
+    )
+
+
+@app.route('/api/cache')
+def api_cache():
+    """Aciertos/fallos de la caché de listas en este proceso."""
+    return jsonify({
+        'pid': os.getpid(),
+        'listas': {
+            name: dict(CACHE_STATS.get(name, {'hits': 0, 'misses': 0}),
+                       version=_list_cache.get((current_tenant(), name), (None,))[0])
+            for name in CACHED_LISTS
+        },
+    })
+
+
+# ---- TRABAJOS EN SEGUNDO PLANO ----
+
+@app.route('/trabajos')
+def trabajos():
+    status = request.args.get('status', default='', type=str)
+    query = Job.query
+    if status:
+        query = query.filter(Job.status == status)
+    jobs = query.order_by(Job.id.desc()).limit(100).all()
+    return render_template(
+        'trabajos.html',
+        jobs=jobs,
+        job_statuses=JOB_STATUSES,
+        selected_status=status,
+    )
+
+
+@app.route('/trabajos/reintentar/<int:job_id>', methods=['POST'])
+def reintentar_trabajo(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.status != 'fallido':
+        flash('Solo se pueden reintentar trabajos fallidos.', 'danger')
+        return redirect(url_for('trabajos'))
+
+    job.status = 'pendiente'
+    job.attempts = 0
+    job.run_at = datetime.now()
+    job.finished_at = None
+    db.session.commit()
+    flash('Trabajo puesto de nuevo en cola.', 'success')
+    return redirect(url_for('trabajos'))
+
+
+@app.route('/ventas/exportar', methods=['POST'])
+def exportar_ventas():
+    job = enqueue('exportar_ventas', {
+        'nombre': f"ventas-{datetime.now().strftime('%Y%m%d-%H%M%S')}.csv",
+    })
+    flash(f'Exportación en cola (trabajo #{job.id}). Descárgala desde Trabajos cuando termine.', 'success')
+    return redirect(url_for('trabajos'))
+
+
+@app.route('/exportaciones/<path:nombre>')
+def descargar_exportacion(nombre):
+    return send_from_directory(exports_dir(), nombre, as_attachment=True)
+
+
+# --- COMANDOS CLI ---
+
+@app.cli.command('init-db')
+@click.option('--todos', is_flag=True, help='También en la base de cada tenant.')
+def init_db_command(todos):
+    """Crea las tablas, columnas e índices que falten."""
+    ensure_schema()
+    click.echo('Tablas creadas.')
+    if todos:
+        for name in list_tenants():
+            ensure_schema(tenant_engines.get(name))
+            click.echo(f'  {name}: tablas creadas.')
+
+
+@app.cli.group('tenant')
+def tenant_group():
+    """Administra revendedores (tenants)."""
+
+
+@tenant_group.command('crear')
+@click.argument('nombre')
+def tenant_crear_command(nombre):
+    """Crea la base de un nuevo tenant."""
+    if not TENANT_NAME_RE.match(nombre):
+        raise click.BadParameter('Usa minúsculas, números, guiones o guiones bajos.')
+    ensure_schema(tenant_engines.get(nombre))
+    click.echo(f'Tenant {nombre} listo: {tenant_database_url(nombre)}')
+
+
+@tenant_group.command('lista')
+def tenant_lista_command():
+    """Lista los tenants conocidos."""
+    for name in list_tenants():
+        click.echo(name)
+
+
+@app.cli.command('resumenes')
+@click.option('--lote', default=500, show_default=True, help='Clientes por transacción.')
+def resumenes_command(lote):
+    """Recalcula el resumen de todos los clientes (útil la primera vez)."""
+    ids = [row[0] for row in db.session.execute(db.select(Client.id).order_by(Client.id))]
+    for i in range(0, len(ids), lote):
+        refresh_client_summaries(ids[i:i + lote])
+        db.session.commit()
+    click.echo(f'Resúmenes recalculados: {len(ids)} clientes.')
+
+
+@app.cli.command('archivar')
+@click.option('--meses', default=ARCHIVE_AFTER_MONTHS, show_default=True,
+              help='Meses desde el vencimiento para archivar.')
+@click.option('--lote', default=1000, show_default=True, help='Filas por transacción.')
+def archivar_command(meses, lote):
+    """Mueve las suscripciones vencidas hace tiempo a la tabla de archivo."""
+    moved = archive_expired(meses, lote, on_batch=lambda n: click.echo(f'  {n} archivadas...'))
+    click.echo(f'Archivadas: {moved} suscripciones.')
+
+
+@app.cli.command('linaje')
+@click.option('--gracia', default=RENOVACION_GRACIA_DIAS, show_default=True,
+              help='Días después del fin en que una compra cuenta como renovación.')
+@click.option('--lote', default=1000, show_default=True, help='Filas por transacción.')
+def linaje_command(gracia, lote):
+    """Vincula cada renovación con la suscripción que renueva (datos anteriores)."""
+    linked = backfill_renewals(gracia, lote)
+    click.echo(f'Renovaciones vinculadas: {linked}.')
+
+
+@app.cli.command('worker')
+@click.option('--procesos', '-n', default=1, show_default=True, help='Cantidad de procesos worker.')
+@click.option('--una-vez', is_flag=True, help='Procesa lo pendiente y termina.')
+def worker_command(procesos, una_vez):
+    """Atiende la cola de trabajos con N procesos."""
+    from worker import run_workers
+    run_workers(procesos, once=una_vez)
+
+
+@app.cli.command('encolar')
+@click.argument('kind', type=click.Choice(['notificar', 'vencimientos', 'exportar_ventas', 'archivar', 'pronostico',
+                                           'mantenimiento', 'snapshot_reportes']))
+def encolar_command(kind):
+    """Agrega un trabajo a la cola (útil desde cron)."""
+    payload = {}
+    if kind == 'exportar_ventas':
+        payload['nombre'] = f"ventas-{datetime.now().strftime('%Y%m%d-%H%M%S')}.csv"
+    job = enqueue(kind, payload)
+    click.echo(f'Trabajo #{job.id} ({kind}) en cola.')
+
+
+
+# ---- MANTENIMIENTO DE LA BASE ----
+
+@app.cli.group('mantenimiento')
+@click.option('--todos', is_flag=True, help='En la base principal y en la de cada tenant.')
+@click.pass_context
+def mantenimiento_group(ctx, todos):
+    """ANALYZE, vacuum, integridad, perfiles usados, resúmenes de clientes y estadísticas de la base."""
+    ctx.obj = [None] + list_tenants() if todos else [current_tenant()]
+
+
+def for_each_database(ctx):
+    """Recorre las bases elegidas con --todos, avisando cuál es cada una."""
+    for name in ctx.obj:
+        with tenant_context(name):
+            if len(ctx.obj) > 1:
+                click.echo(f'[{name or "principal"}]')
+            yield name
+
+
+@mantenimiento_group.command('analizar')
+@click.pass_context
+def mantenimiento_analizar_command(ctx):
+    """ANALYZE y PRAGMA optimize para que el planificador use bien los índices."""
+    from maintenance import analyze
+    for _ in for_each_database(ctx):
+        click.echo(f"Estadísticas actualizadas en {analyze()['segundos']} s.")
+
+
+@mantenimiento_group.command('vacuum')
+@click.option('--completo', is_flag=True, help='VACUUM completo (y deja la base en modo incremental).')
+@click.option('--paginas', default=0, help='Máximo de páginas a liberar (0 = todas).')
+@click.pass_context
+def mantenimiento_vacuum_command(ctx, completo, paginas):
+    """Devuelve al disco el espacio libre de la base."""
+    from maintenance import vacuum
+    for _ in for_each_database(ctx):
+        result = vacuum(completo, paginas)
+        if result['modo'] == 'omitido':
+            click.echo(result['nota'])
+        else:
+            click.echo(f"Vacuum {result['modo']}: {result.get('bytes_liberados', 0) / 1024:.0f} KB "
+                       f"liberados en {result['segundos']} s.")
+
+
+@mantenimiento_group.command('integridad')
+@click.option('--rapido', is_flag=True, help='quick_check en lugar de integrity_check.')
+@click.pass_context
+def mantenimiento_integridad_command(ctx, rapido):
+    """Revisa la integridad de la base y las claves foráneas."""
+    from maintenance import integrity_check
+    failed = False
+    for _ in for_each_database(ctx):
+        result = integrity_check(rapido)
+        for problem in result['problemas']:
+            click.echo(f'  {problem}')
+        click.echo(result.get('nota') or ('Integridad OK.' if result['ok'] else 'Se encontraron problemas.'))
+        failed = failed or not result['ok']
+    if failed:
+        ctx.exit(1)
+
+
+@mantenimiento_group.command('perfiles')
+@click.option('--solo-revisar', is_flag=True, help='Muestra las diferencias sin corregirlas.')
+@click.pass_context
+def mantenimiento_perfiles_command(ctx, solo_revisar):
+    """Recalcula used_slots de cada cuenta con sus suscripciones vigentes."""
+    from maintenance import reconcile_slots
+    for _ in for_each_database(ctx):
+        changes = reconcile_slots(apply=not solo_revisar)
+        db.session.commit()
+        for account_id, service, user, before, now in changes:
+            click.echo(f'  #{account_id} {service} ({user}): {before} -> {now}')
+        verb = 'con diferencias' if solo_revisar else 'corregidas'
+        click.echo(f'Cuentas {verb}: {len(changes)}.')
+
+
+@mantenimiento_group.command('stats')
+@click.option('--lentas', default=10, show_default=True, help='Consultas lentas a mostrar.')
+@click.option('--json', 'as_json', is_flag=True, help='Salida en JSON.')
+@click.pass_context
+def mantenimiento_stats_command(ctx, lentas, as_json):
+    """Tamaño de tablas e índices, uso de índices y consultas más lentas."""
+    from maintenance import database_stats
+
+    def kb(value):
+        return '-' if value is None else f'{value / 1024:,.0f} KB'
+
+    for name in for_each_database(ctx):
+        stats = database_stats(lentas)
+        if as_json:
+            click.echo(json.dumps(dict(stats, tenant=name), ensure_ascii=False, indent=2))
+            continue
+
+        general = stats['general']
+        click.echo(f"Motor: {stats['motor']} · tamaño {kb(general['bytes'])}"
+                   + (f" · {general['paginas_libres']} páginas libres · auto_vacuum {general['auto_vacuum']}"
+                      if 'paginas_libres' in general else ''))
+        last = stats['ultimo_mantenimiento']
+        click.echo(f"Último mantenimiento: {last['fecha'] if last else 'nunca'}")
+
+        click.echo('\nTablas:')
+        for t in stats['tablas']:
+            click.echo(f"  {t['nombre']:<28} {t['filas']:>10,} filas {kb(t['bytes']):>12}")
+
+        click.echo('\nÍndices:')
+        for i in stats['indices']:
+            if 'lecturas' in i:
+                uso = f"{i['lecturas']:,} lecturas"
+            elif i['analizado']:
+                uso = f"~{i['filas_por_clave']} filas por clave"
+            else:
+                uso = 'sin estadísticas (corre analizar)'
+            click.echo(f"  {i['tabla'] + '.' + i['nombre']:<58} {kb(i['bytes']):>12}  {uso}")
+
+        click.echo(f"\nConsultas más lentas (>= {app.config['SLOW_QUERY_MS']} ms):")
+        for q in stats['consultas_lentas']:
+            click.echo(f"  {q['max_ms']:>9.0f} ms máx · {q['promedio_ms']:.0f} ms prom · "
+                       f"{q['veces']} veces · última {q['ultima']}")
+            click.echo(f"    {q['sql'][:200]}")
+        if not stats['consultas_lentas']:
+            click.echo('  (ninguna registrada)')
+
+
+@mantenimiento_group.command('todo')
+@click.pass_context
+def mantenimiento_todo_command(ctx):
+    """Corre ahora todas las tareas: perfiles, resúmenes, analizar, vacuum e integridad."""
+    from maintenance import run_maintenance
+    for _ in for_each_database(ctx):
+        run_maintenance(on_task=lambda name, result: click.echo(f'  {name}: {json.dumps(result, ensure_ascii=False)}'))
+
+
+@mantenimiento_group.command('programar')
+@click.option('--hora', type=click.IntRange(0, 23), default=None,
+              help='Hora del día (por defecto MAINTENANCE_HOUR).')
+@click.option('--cancelar', is_flag=True, help='Quita el mantenimiento programado.')
+@click.pass_context
+def mantenimiento_programar_command(ctx, hora, cancelar):
+    """Deja el mantenimiento en la cola para cada madrugada (lo corre `flask worker`)."""
+    from maintenance import pending_maintenance, schedule_maintenance
+    for _ in for_each_database(ctx):
+        if cancelar:
+            jobs = pending_maintenance()
+            for job in jobs:
+                db.session.delete(job)
+            db.session.commit()
+            click.echo(f'Mantenimientos cancelados: {len(jobs)}.')
+        else:
+            job = schedule_maintenance(hora)
+            click.echo(f"Mantenimiento programado (trabajo #{job.id}) para {job.run_at:%Y-%m-%d %H:%M}; "
+                       'se vuelve a programar solo cada día.')
+
+
+# ---- BASE DE REPORTES ----
+
+@app.cli.group('reportes')
+@click.option('--todos', is_flag=True, help='En la base principal y en la de cada tenant.')
+@click.pass_context
+def reportes_group(ctx, todos):
+    """Copia de solo lectura que usan los reportes (REPORTING_MODE=snapshot)."""
+    ctx.obj = [None] + list_tenants() if todos else [current_tenant()]
+
+
+@reportes_group.command('snapshot')
+@click.pass_context
+def reportes_snapshot_command(ctx):
+    """Refresca ahora la copia para reportes."""
+    for _ in for_each_database(ctx):
+        result = refresh_snapshot()
+        click.echo(f"Copia {os.path.basename(result['archivo'])}: {result['bytes'] / 1024 / 1024:.1f} MB "
+                   f"en {result['segundos']} s.")
+
+
+@reportes_group.command('programar')
+@click.option('--minutos', type=click.IntRange(1), default=None,
+              help='Cada cuántos minutos (por defecto REPORTING_SNAPSHOT_MINUTES).')
+@click.option('--cancelar', is_flag=True, help='Quita el refresco programado.')
+@click.pass_context
+def reportes_programar_command(ctx, minutos, cancelar):
+    """Deja el refresco de la copia en la cola (lo corre `flask worker`)."""
+    for _ in for_each_database(ctx):
+        if cancelar:
+            deleted = db.session.execute(
+                db.delete(Job).where(Job.kind == 'snapshot_reportes', Job.status == 'pendiente')
+            ).rowcount
+            db.session.commit()
+            click.echo(f'Refrescos cancelados: {deleted}.')
+        else:
+            job = schedule_snapshots(minutos)
+            click.echo(f"Refresco programado (trabajo #{job.id}) para {job.run_at:%H:%M}; "
+                       f"se repite cada {job.data['minutos']} minutos.")
+
+
+@reportes_group.command('estado')
+@click.pass_context
+def reportes_estado_command(ctx):
+    """Muestra de dónde leen hoy los reportes y qué tan viejos son los datos."""
+    click.echo(f"Modo: {app.config['REPORTING_MODE'] or 'desactivado'} · "
+               f"máximo atraso {app.config['REPORTING_MAX_STALE_MINUTES']} min")
+    for name in for_each_database(ctx):
+        if app.config['REPORTING_MODE'] == 'snapshot':
+            snapshots = list_snapshots(name)
+            click.echo(f"Última copia: {os.path.basename(snapshots[-1][1]) if snapshots else 'ninguna'}")
+        _, info = reporting_source()
+        click.echo(f"Los reportes leen de: {info['modo']} (datos al {info['datos_al']:%Y-%m-%d %H:%M:%S}, "
+                   f"{info['atraso_s'] // 60} min de atraso)")
+
 # --- INICIO APP ---
 
+def precompile_templates() -> int:
+    """Compila todas las plantillas y las deja en la caché de Jinja (memoria y disco)."""
+    names = [n for n in app.jinja_env.list_templates() if n.endswith('.html')]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def warm_up() -> Flask:
+    """Calienta la app global para servir tráfico: plantillas compiladas, numpy y mappers.
+
+    No es una fábrica: devuelve siempre el mismo `app` del módulo, con sus rutas.
+    No corre al importar (worker, notifier, CLI y mantenimiento no lo
+    necesitan); lo llama gunicorn con 'app:warm_up()' (ver gunicorn.conf.py).
+    Con preload_app corre una sola vez en el master y los workers lo heredan;
+    post_fork suelta las conexiones que se hayan heredado. Al arrancar también
+    pone al día el esquema de todas las bases (como `flask init-db --todos`).
+    """
+    if app.extensions.get('ventas.arranque'):
+        return app
+
+    with app.app_context():
+        ensure_all_schemas()
+
+    cache_dir = app.config['JINJA_CACHE_DIR'] or os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    if app.config['STARTUP_WARMUP']:
+        precompile_templates()
+        import numpy  # noqa: F401  (panel, analítica y pronóstico; tarda más que compilar todo)
+
+    db.configure_mappers()
+    app.extensions['ventas.arranque'] = True
+    return app
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        ensure_schema()
     app.run(debug=True, port=5006)
@@ -0,0 +1,148 @@
+"""Pronóstico de ingresos a 30/60/90 días por moneda, vendedor y servicio.
+
+Cada suscripción que vence en el horizonte y todavía no fue renovada aporta
+precio × probabilidad de renovación. La probabilidad se aprende del historial
+(renewed_from_id) por servicio y vendedor, suavizada hacia la del servicio y
+la global cuando hay pocos datos. Todo se calcula con numpy sobre la misma
+foto por columnas que usa analytics.py, y el resultado se guarda por día.
+"""
+from datetime import date
+import json
+import time
+
+import numpy as np
+
+from app import db, get_state, set_state, current_tenant, RENOVACION_GRACIA_DIAS
+from analytics import load_snapshot, renewal_outcomes
+
+HORIZONTES = (30, 60, 90)
+
+# Peso (en suscripciones) del promedio más general al estimar un grupo chico
+PESO_PREVIO = 20
+
+# Probabilidad usada cuando todavía no hay historial
+PROBABILIDAD_INICIAL = 0.5
+
+FORECAST_STATE_KEY = 'pronostico'
+
+_cache = {}  # tenant -> pronóstico del día (por proceso)
+
+
+def renewal_probabilities(snap: dict, renewed, decided):
+    """Probabilidad de renovación de cada suscripción según su servicio y vendedor.
+
+    p(servicio, vendedor) = (renovadas + PESO_PREVIO · p(servicio)) / (decididas + PESO_PREVIO),
+    y p(servicio) se suaviza igual hacia la probabilidad global.
+    """
+    n_services, n_sellers = len(snap['services']), len(snap['sellers'])
+    kept = decided & renewed
+
+    n_decided = int(np.count_nonzero(decided))
+    p_global = np.count_nonzero(kept) / n_decided if n_decided else PROBABILIDAD_INICIAL
+
+    service_total = np.bincount(snap['service'][decided], minlength=n_services)
+    service_kept = np.bincount(snap['service'][kept], minlength=n_services)
+    p_service = (service_kept + PESO_PREVIO * p_global) / (service_total + PESO_PREVIO)
+
+    segment = snap['service'] * n_sellers + snap['seller']
+    segment_total = np.bincount(segment[decided], minlength=n_services * n_sellers)
+    segment_kept = np.bincount(segment[kept], minlength=n_services * n_sellers)
+    p_segment = (segment_kept + PESO_PREVIO * np.repeat(p_service, n_sellers)) / (segment_total + PESO_PREVIO)
+
+    return p_segment[segment], float(p_global)
+
+
+def _grouped(codes, n_groups, windows, price, prob) -> dict:
+    """Cantidad, monto en riesgo y monto esperado por grupo y horizonte."""
+    result = {}
+    for h, mask in windows.items():
+        result[h] = {
+            'cantidad': np.bincount(codes[mask], minlength=n_groups),
+            'en_riesgo': np.bincount(codes[mask], weights=price[mask], minlength=n_groups),
+            'esperado': np.bincount(codes[mask], weights=(price * prob)[mask], minlength=n_groups),
+            'renovaciones': np.bincount(codes[mask], weights=prob[mask], minlength=n_groups),
+        }
+    return result
+
+
+def _rows(grouped, label) -> list:
+    """Filas JSON de los grupos con vencimientos en el horizonte más largo."""
+    longest = HORIZONTES[-1]
+    rows = []
+    for idx in np.flatnonzero(grouped[longest]['cantidad']):
+        row = label(idx)
+        for h in HORIZONTES:
+            g = grouped[h]
+            row[f'd{h}'] = {
+                'cantidad': int(g['cantidad'][idx]),
+                'en_riesgo': round(float(g['en_riesgo'][idx]), 2),
+                'esperado': round(float(g['esperado'][idx]), 2),
+                'renovaciones': round(float(g['renovaciones'][idx]), 1),
+            }
+        rows.append(row)
+    return sorted(rows, key=lambda r: (r.get('moneda', ''), -r[f'd{longest}']['esperado']))
+
+
+def build_forecast(today: date = None, grace_days: int = RENOVACION_GRACIA_DIAS) -> dict:
+    """Pronóstico completo (listo para JSON) sobre la base actual."""
+    today = today or date.today()
+    t0 = time.perf_counter()
+    snap = load_snapshot()
+    renewed, decided = renewal_outcomes(snap, today, grace_days)
+    prob, p_global = renewal_probabilities(snap, renewed, decided)
+
+    day = np.datetime64(today, 'D')
+    pending = ~renewed & (snap['end'] >= day)
+    windows = {h: pending & (snap['end'] < day + np.timedelta64(h, 'D')) for h in HORIZONTES}
+
+    currencies, sellers, services = snap['currencies'], snap['sellers'], snap['services']
+    n_cur = len(currencies)
+    price = snap['price']
+
+    by_currency = _grouped(snap['currency'], n_cur, windows, price, prob)
+    by_seller = _grouped(snap['currency'] * len(sellers) + snap['seller'],
+                         n_cur * len(sellers), windows, price, prob)
+    by_service = _grouped(snap['currency'] * len(services) + snap['service'],
+                          n_cur * len(services), windows, price, prob)
+
+    return {
+        'fecha': today.isoformat(),
+        'horizontes': list(HORIZONTES),
+        'probabilidad_global': round(p_global, 3),
+        'por_moneda': _rows(by_currency, lambda i: {'moneda': currencies[i]}),
+        'por_vendedor': _rows(by_seller, lambda i: {
+            'moneda': currencies[i // len(sellers)], 'nombre': sellers[i % len(sellers)],
+        }),
+        'por_servicio': _rows(by_service, lambda i: {
+            'moneda': currencies[i // len(services)], 'nombre': services[i % len(services)],
+        }),
+        'segundos': round(time.perf_counter() - t0, 3),
+    }
+
+
+def cached_forecast(today: date = None, refresh: bool = False) -> dict:
+    """Pronóstico del día.
+
+    Se busca primero en la memoria del proceso y luego en AppState (compartido
+    por todos los workers); solo si no hay uno de hoy se recalcula y se guarda.
+    """
+    today = today or date.today()
+    tenant = current_tenant()
+
+    if not refresh:
+        report = _cache.get(tenant)
+        if report and report['fecha'] == today.isoformat():
+            return report
+
+        stored = get_state(FORECAST_STATE_KEY)
+        if stored:
+            report = json.loads(stored)
+            if report['fecha'] == today.isoformat():
+                _cache[tenant] = report
+                return report
+
+    report = build_forecast(today)
+    set_state(FORECAST_STATE_KEY, json.dumps(report))
+    db.session.commit()
+    _cache[tenant] = report
+    return report
@@ -0,0 +1,22 @@
+"""Configuración de gunicorn.
+
+    gunicorn            # usa wsgi_app de abajo: 'app:warm_up()'
+
+warm_up() compila las plantillas e importa numpy. Con preload_app eso se
+hace una sola vez en el master y los workers nuevos o reciclados lo heredan
+por fork, en lugar de importar y compilar todo de nuevo. GUNICORN_PRELOAD=0
+lo desactiva (cada worker llama a warm_up() al arrancar).
+"""
+import os
+
+wsgi_app = 'app:warm_up()'
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+
+def post_fork(server, worker):
+    """Cada worker abre sus propias conexiones; las del master no se comparten."""
+    from app import app, reset_engines_after_fork
+    with app.app_context():
+        reset_engines_after_fork()
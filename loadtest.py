@@ -0,0 +1,448 @@
+"""Prueba de carga HTTP: levanta la app con gunicorn sobre una base generada
+y mide rendimiento y latencias (p50/p95/p99) por endpoint.
+
+Uso:
+    python loadtest.py --workers 4 --concurrencia 16 --duracion 30
+    python loadtest.py --url http://127.0.0.1:8000 --db /tmp/carga.db   # servidor ya levantado
+    python loadtest.py --arranque                # tiempo hasta la primera respuesta de un worker nuevo
+    python loadtest.py --reportes                # latencia de las ventas con reportes pesados en paralelo
+"""
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+import requests
+from sqlalchemy import create_engine, insert, select, func
+
+from app import db, Client, Seller, Account, Subscription, MessageTemplate, DEFAULT_MESSAGES
+
+SERVICES = ['Netflix', 'Disney+', 'Max', 'Prime Video', 'Spotify', 'Crunchyroll', 'YouTube Premium']
+NOMBRES = ['Ana', 'Luis', 'María', 'José', 'Carla', 'Jorge', 'Lucía', 'Pedro', 'Sofía', 'Diego']
+APELLIDOS = ['Flores', 'Quispe', 'Mamani', 'Rojas', 'Vargas', 'Gutiérrez', 'López', 'Pérez']
+
+# Peso relativo de cada tipo de petición en la mezcla
+MIX = {
+    'panel': 20,
+    'ventas_buscar': 30,
+    'cliente_detalle': 30,
+    'venta_nueva': 10,
+    'venta_renovar': 10,
+}
+
+# Mezclas de --reportes: solo escrituras, y reportes pesados que corren a la vez
+MIX_ESCRITURAS = {'venta_nueva': 50, 'venta_renovar': 50}
+MIX_REPORTES = {'analitica': 50, 'reporte_detalle_csv': 50}
+
+
+# --- BASE DE DATOS DE PRUEBA ---
+
+def generate_database(path, clients=2000, sellers=5, accounts=300, subscriptions=20000, seed=1):
+    """Crea una base SQLite con datos realistas para la prueba."""
+    rnd = random.Random(seed)
+    today = date.today()
+
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        conn.execute(insert(Seller), [
+            {'name': f'Vendedor {i + 1}', 'phone': f'7{rnd.randint(1000000, 9999999)}'}
+            for i in range(sellers)
+        ])
+        conn.execute(insert(Client), [
+            {
+                'name': f'{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)} {i}',
+                'country_code': rnd.choice(['591', '54', '56']),
+                'phone': f'7{rnd.randint(1000000, 9999999)}',
+            }
+            for i in range(clients)
+        ])
+
+        per_account = subscriptions // accounts + 1
+        conn.execute(insert(Account), [
+            {
+                'service': rnd.choice(SERVICES),
+                'user': f'cuenta{i}@correo.com',
+                'password': 'secreto',
+                'total_slots': per_account + 1000,  # espacio de sobra para las ventas de la prueba
+                'used_slots': 0,
+            }
+            for i in range(accounts)
+        ])
+
+        rows = []
+        for _ in range(subscriptions):
+            start = today - timedelta(days=rnd.randint(0, 730))
+            rows.append({
+                'client_id': rnd.randint(1, clients),
+                'account_id': rnd.randint(1, accounts),
+                'seller_id': rnd.randint(1, sellers),
+                'start_date': start,
+                'end_date': start + timedelta(days=rnd.choice([30, 30, 30, 60, 90])),
+                'price': rnd.choice([25.0, 30.0, 35.0, 50.0, 70.0]),
+                'currency': rnd.choice(['BOB', 'BOB', 'ARS', 'CLP']),
+                'platform': rnd.choice(['whatsapp', 'whatsapp', 'messenger']),
+                'payment_status': rnd.choice(['pagado', 'pagado', 'pagado', 'pendiente', 'renovado']),
+                'status': 'activa',
+            })
+        conn.execute(insert(Subscription), rows)
+
+        for account_id, used in conn.execute(
+            select(Subscription.account_id, func.count()).group_by(Subscription.account_id)
+        ).all():
+            conn.execute(
+                Account.__table__.update()
+                .where(Account.id == account_id)
+                .values(used_slots=used)
+            )
+
+        conn.execute(insert(MessageTemplate), [
+            {'key': key, 'name': key.capitalize(), 'content': content}
+            for key, content in DEFAULT_MESSAGES.items()
+        ])
+
+    engine.dispose()
+
+
+# --- SERVIDOR ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(db_path, workers, port, extra_args=(), extra_env=None):
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{os.path.abspath(db_path)}', **(extra_env or {}))
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}',
+         '--log-level', 'warning', *extra_args, 'app:warm_up()'],
+        env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('gunicorn terminó antes de aceptar conexiones')
+        try:
+            requests.get(f'{base_url}/test', timeout=1)
+            return proc, base_url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('gunicorn no respondió a tiempo')
+
+
+# --- CARGA ---
+
+class Scenario:
+    """Arma las peticiones de la mezcla con ids que existen en la base."""
+
+    def __init__(self, db_path, seed):
+        engine = create_engine(f'sqlite:///{db_path}')
+        with engine.connect() as conn:
+            self.client_ids = [r[0] for r in conn.execute(select(Client.id))]
+            self.seller_ids = [r[0] for r in conn.execute(select(Seller.id))]
+            self.account_ids = [r[0] for r in conn.execute(select(Account.id))]
+            self.sub_ids = [r[0] for r in conn.execute(select(Subscription.id))]
+            self.client_names = [r[0] for r in conn.execute(select(Client.name).limit(500))]
+        engine.dispose()
+        self.seed = seed
+
+    def request(self, rnd, kind):
+        """Devuelve (método, ruta, datos del formulario)."""
+        today = date.today().isoformat()
+        if kind == 'panel':
+            return 'GET', '/', None
+        if kind == 'analitica':
+            return 'GET', '/analitica', None
+        if kind == 'reporte_detalle_csv':
+            return 'GET', '/vendedores/reporte.csv?detalle=1&desde=2000-01-01', None
+        if kind == 'ventas_buscar':
+            q = rnd.choice([rnd.choice(self.client_names).split()[0], rnd.choice(SERVICES), str(rnd.randint(70, 79))])
+            return 'GET', f'/ventas?q={q}', None
+        if kind == 'cliente_detalle':
+            return 'GET', f'/clientes/{rnd.choice(self.client_ids)}', None
+        if kind == 'venta_nueva':
+            return 'POST', '/ventas/nueva', {
+                'client_type': 'existente',
+                'client_id': rnd.choice(self.client_ids),
+                'seller_id': rnd.choice(self.seller_ids),
+                'platform': 'whatsapp',
+                'payment_status': 'pagado',
+                'start_date': today,
+                'days': 30,
+                'account_id[]': [rnd.choice(self.account_ids)],
+                'price[]': ['35'],
+                'currency[]': ['BOB'],
+                'slot[]': ['Perfil'],
+            }
+        if kind == 'venta_renovar':
+            return 'POST', f'/ventas/renovar/{rnd.choice(self.sub_ids)}', {
+                'start_date': today,
+                'days': 30,
+                'price': '35',
+                'payment_status': 'pagado',
+            }
+        raise ValueError(kind)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def run_load(base_url, scenario, concurrency, duration, seed=1, stop_event=None, mix=MIX):
+    """Lanza `concurrency` hilos durante `duration` segundos. Devuelve {tipo: [(latencia, ok)]}."""
+    results = defaultdict(list)
+    lock = threading.Lock()
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    deadline = time.time() + duration
+
+    def user(n):
+        rnd = random.Random(seed * 1000 + n)
+        session = requests.Session()
+        local = defaultdict(list)
+        while time.time() < deadline and not (stop_event and stop_event.is_set()):
+            kind = rnd.choices(kinds, weights)[0]
+            method, path, data = scenario.request(rnd, kind)
+            t0 = time.perf_counter()
+            try:
+                r = session.request(method, base_url + path, data=data, allow_redirects=False, timeout=120)
+                ok = r.status_code < 400
+                r.content  # los CSV llegan en streaming: contar hasta el último byte
+            except requests.RequestException:
+                ok = False
+            local[kind].append((time.perf_counter() - t0, ok))
+        with lock:
+            for kind, values in local.items():
+                results[kind].extend(values)
+
+    threads = [threading.Thread(target=user, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def summarize(results, elapsed, mix=MIX):
+    """Filas de reporte por endpoint más una fila 'total'."""
+    rows = []
+    all_values = []
+    for kind in list(mix) + ['total']:
+        values = all_values if kind == 'total' else results.get(kind, [])
+        if kind != 'total':
+            all_values.extend(values)
+        latencies = sorted(v[0] for v in values)
+        errors = sum(1 for v in values if not v[1])
+        rows.append({
+            'endpoint': kind,
+            'peticiones': len(values),
+            'rps': len(values) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'errores_pct': 100.0 * errors / len(values) if values else 0.0,
+        })
+    return rows
+
+
+def print_report(rows):
+    print(f"{'endpoint':<18}{'peticiones':>11}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errores':>9}")
+    for r in rows:
+        print(
+            f"{r['endpoint']:<18}{r['peticiones']:>11}{r['rps']:>9.1f}"
+            f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['errores_pct']:>8.1f}%"
+        )
+
+
+# --- ARRANQUE ---
+
+# Páginas que un worker recién creado atiende primero (cada una con su plantilla)
+ARRANQUE_RUTAS = ['/', '/ventas/nueva', '/clientes/1', '/ventas?q=Netflix', '/cuentas', '/trabajos']
+
+ARRANQUE_MODOS = [
+    ('perezoso (sin calentar)', {'GUNICORN_PRELOAD': '0', 'STARTUP_WARMUP': '0'}, True),
+    ('sin preload, caché fría', {'GUNICORN_PRELOAD': '0'}, True),
+    ('sin preload, caché en disco', {'GUNICORN_PRELOAD': '0'}, False),
+    ('preload', {'GUNICORN_PRELOAD': '1'}, False),
+]
+
+
+def measure_startup(db_path, extra_env, cache_dir, clear_cache):
+    """Segundos hasta que gunicorn responde y ms de la primera y segunda petición a cada página."""
+    if clear_cache:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    t0 = time.perf_counter()
+    proc, base_url = start_gunicorn(db_path, 1, free_port(),
+                                    extra_env=dict(extra_env, JINJA_CACHE_DIR=cache_dir))
+    ready = time.perf_counter() - t0
+    try:
+        session = requests.Session()
+        first, second = [], []
+        for times in (first, second):
+            for path in ARRANQUE_RUTAS:
+                t = time.perf_counter()
+                session.get(base_url + path, timeout=30)
+                times.append(time.perf_counter() - t)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return {'listo_s': ready, 'primera_ms': sum(first) * 1000, 'segunda_ms': sum(second) * 1000}
+
+
+def run_startup_benchmark(db_path, rounds):
+    cache_dir = tempfile.mkdtemp(prefix='jinja-')
+    try:
+        print(f"Arranque de 1 worker, mediana de {rounds} rondas; "
+              f"'primera' y 'segunda' suman {len(ARRANQUE_RUTAS)} páginas")
+        print(f"{'modo':<30}{'listo s':>9}{'primera ms':>12}{'segunda ms':>12}")
+        for label, extra_env, clear_cache in ARRANQUE_MODOS:
+            runs = [measure_startup(db_path, extra_env, cache_dir, clear_cache) for _ in range(rounds)]
+            med = {key: sorted(r[key] for r in runs)[len(runs) // 2] for key in runs[0]}
+            print(f"{label:<30}{med['listo_s']:>9.2f}{med['primera_ms']:>12.1f}{med['segunda_ms']:>12.1f}")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+# --- REPORTES EN PARALELO ---
+
+REPORTES_MODOS = [
+    ('sin reportes', None),
+    ('reportes en la principal', {'REPORTING_MODE': ''}),
+    ('reportes en la copia', {'REPORTING_MODE': 'snapshot'}),
+]
+
+
+def take_snapshot(db_path, env):
+    """Refresca la copia de reportes con el comando de la app (como lo haría el worker)."""
+    subprocess.run(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'reportes', 'snapshot'],
+        env=dict(os.environ, DATABASE_URL=f'sqlite:///{os.path.abspath(db_path)}', **env),
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True, stdout=subprocess.DEVNULL,
+    )
+
+
+def run_reporting_benchmark(db_path, workers, concurrency, duration, seed):
+    """Latencia de las ventas sola, con reportes pesados en la base principal y en la copia."""
+    report_dir = tempfile.mkdtemp(prefix='reportes-')
+    report_users = max(1, concurrency // 4)
+    try:
+        scenario = Scenario(db_path, seed)
+        print(f'Ventas: {concurrency} usuarios durante {duration:.0f}s; reportes: {report_users} usuarios '
+              f'({workers} workers para ventas + {report_users} para reportes)')
+        print(f"{'modo':<28}{'ventas':>8}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+              f"{'errores':>9}{'reportes':>10}")
+        for label, extra_env in REPORTES_MODOS:
+            env = dict(extra_env or {}, REPORTING_DIR=report_dir)
+            if env.get('REPORTING_MODE') == 'snapshot':
+                take_snapshot(db_path, env)
+            proc, base_url = start_gunicorn(db_path, workers + report_users, free_port(), extra_env=env)
+            try:
+                stop = threading.Event()
+                reports = {}
+                if extra_env is not None:
+                    def report_load():
+                        reports.update(run_load(base_url, scenario, report_users, duration + 60, seed=seed + 1,
+                                                stop_event=stop, mix=MIX_REPORTES))
+                    reporter = threading.Thread(target=report_load)
+                    reporter.start()
+                    time.sleep(1)  # que los reportes ya estén leyendo cuando empiezan las ventas
+                t0 = time.time()
+                results = run_load(base_url, scenario, concurrency, duration, seed=seed, mix=MIX_ESCRITURAS)
+                total = summarize(results, time.time() - t0, mix=MIX_ESCRITURAS)[-1]
+                stop.set()
+                if extra_env is not None:
+                    reporter.join()
+                done = sum(len(v) for v in reports.values())
+                print(f"{label:<28}{total['peticiones']:>8}{total['rps']:>8.1f}{total['p50_ms']:>9.1f}"
+                      f"{total['p95_ms']:>9.1f}{total['p99_ms']:>9.1f}{total['errores_pct']:>8.1f}%"
+                      f"{done if extra_env is not None else '-':>10}")
+            finally:
+                proc.terminate()
+                proc.wait(timeout=10)
+    finally:
+        shutil.rmtree(report_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga contra gunicorn.')
+    parser.add_argument('--workers', type=int, default=2, help='Workers de gunicorn.')
+    parser.add_argument('--concurrencia', type=int, default=8, help='Usuarios simultáneos.')
+    parser.add_argument('--duracion', type=float, default=20, help='Segundos de carga.')
+    parser.add_argument('--clientes', type=int, default=2000)
+    parser.add_argument('--suscripciones', type=int, default=20000)
+    parser.add_argument('--db', help='Usar esta base (si no existe se genera).')
+    parser.add_argument('--url', help='Servidor ya levantado; no se inicia gunicorn.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--arranque', action='store_true',
+                        help='Mide el arranque de un worker nuevo en lugar de la carga.')
+    parser.add_argument('--rondas', type=int, default=3, help='Rondas por modo en --arranque.')
+    parser.add_argument('--reportes', action='store_true',
+                        help='Compara la latencia de las ventas con reportes pesados en la principal y en la copia.')
+    args = parser.parse_args()
+
+    tmpdir = None
+    db_path = args.db
+    if not db_path:
+        tmpdir = tempfile.mkdtemp(prefix='carga-')
+        db_path = os.path.join(tmpdir, 'carga.db')
+    if not os.path.exists(db_path):
+        print(f'Generando base de prueba en {db_path} ...')
+        generate_database(db_path, clients=args.clientes, subscriptions=args.suscripciones, seed=args.seed)
+
+    if args.arranque:
+        try:
+            run_startup_benchmark(db_path, args.rondas)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        return
+
+    if args.reportes:
+        try:
+            run_reporting_benchmark(db_path, args.workers, args.concurrencia, args.duracion, args.seed)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        return
+
+    proc = None
+    base_url = args.url
+    if not base_url:
+        proc, base_url = start_gunicorn(db_path, args.workers, free_port())
+
+    try:
+        scenario = Scenario(db_path, args.seed)
+        print(f'Carga: {args.concurrencia} usuarios durante {args.duracion:.0f}s contra {base_url} '
+              f'({args.workers} workers)')
+        t0 = time.time()
+        results = run_load(base_url, scenario, args.concurrencia, args.duracion, seed=args.seed)
+        print_report(summarize(results, time.time() - t0))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=10)
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
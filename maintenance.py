@@ -0,0 +1,312 @@
+"""Mantenimiento de la base: estadísticas del planificador, vacuum, chequeo de
+integridad, conciliación de perfiles usados, resúmenes de clientes vencidos y reporte de tamaños y consultas lentas.
+
+Las tareas se pueden correr a mano (`flask mantenimiento ...`) o dejarse
+programadas en la cola de trabajos para la madrugada; el trabajo se vuelve a
+programar solo para el día siguiente.
+"""
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import json
+import os
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from app import (
+    app, db, Account, Subscription, Job,
+    current_engine, enqueue, get_state, set_state, invalidate_cache, slow_query_log_path,
+    refresh_stale_summaries,
+    RENOVACION_GRACIA_DIAS,
+)
+
+# Orden en que corre `flask mantenimiento todo` y el trabajo programado
+TAREAS = ('perfiles', 'resumenes', 'analizar', 'vacuum', 'integridad')
+
+MAINTENANCE_STATE_KEY = 'mantenimiento'
+
+
+@contextmanager
+def autocommit():
+    """Conexión fuera de transacción (VACUUM no puede correr dentro de una)."""
+    db.session.commit()  # suelta la transacción de lectura de la sesión
+    with current_engine().connect() as conn:
+        yield conn.execution_options(isolation_level='AUTOCOMMIT')
+
+
+def is_sqlite() -> bool:
+    return current_engine().dialect.name == 'sqlite'
+
+
+# --- TAREAS ---
+
+def analyze() -> dict:
+    """Actualiza las estadísticas que usa el planificador para elegir índices."""
+    t0 = time.perf_counter()
+    with autocommit() as conn:
+        conn.exec_driver_sql('ANALYZE')
+        if is_sqlite():
+            conn.exec_driver_sql('PRAGMA optimize')
+    return {'segundos': round(time.perf_counter() - t0, 2)}
+
+
+def vacuum(full: bool = False, pages: int = 0) -> dict:
+    """Devuelve al disco las páginas libres.
+
+    En SQLite el vacuum incremental solo funciona con auto_vacuum=INCREMENTAL;
+    full=True hace un VACUUM completo y deja la base en ese modo, así las
+    próximas veces alcanza con el incremental (mucho más corto).
+    """
+    t0 = time.perf_counter()
+    with autocommit() as conn:
+        if not is_sqlite():
+            conn.exec_driver_sql('VACUUM FULL' if full else 'VACUUM')
+            return {'modo': 'completo' if full else 'normal',
+                    'segundos': round(time.perf_counter() - t0, 2)}
+
+        page_size = conn.exec_driver_sql('PRAGMA page_size').scalar()
+        free_before = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+        incremental = conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2
+
+        if full:
+            conn.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.exec_driver_sql('VACUUM')
+            mode = 'completo'
+        elif incremental:
+            # El pragma libera una página por paso; executescript lo corre hasta el final
+            conn.connection.driver_connection.executescript(
+                f'PRAGMA incremental_vacuum({int(pages)})' if pages else 'PRAGMA incremental_vacuum')
+            mode = 'incremental'
+        else:
+            return {
+                'modo': 'omitido',
+                'paginas_libres': free_before,
+                'nota': 'La base no está en auto_vacuum=INCREMENTAL; corre una vez '
+                        '`flask mantenimiento vacuum --completo`.',
+            }
+
+        free_after = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+    return {
+        'modo': mode,
+        'paginas_libres': free_after,
+        'bytes_liberados': (free_before - free_after) * page_size,
+        'segundos': round(time.perf_counter() - t0, 2),
+    }
+
+
+def integrity_check(quick: bool = False) -> dict:
+    """PRAGMA integrity_check (o quick_check) y claves foráneas huérfanas."""
+    if not is_sqlite():
+        return {'ok': True, 'problemas': [], 'nota': 'Solo disponible en SQLite.'}
+
+    t0 = time.perf_counter()
+    with autocommit() as conn:
+        pragma = 'quick_check' if quick else 'integrity_check'
+        problems = [row[0] for row in conn.exec_driver_sql(f'PRAGMA {pragma}') if row[0] != 'ok']
+        problems += [
+            f'{table} rowid {rowid}: no existe la fila referenciada en {parent}'
+            for table, rowid, parent, _ in conn.exec_driver_sql('PRAGMA foreign_key_check')
+        ]
+    return {'ok': not problems, 'problemas': problems,
+            'segundos': round(time.perf_counter() - t0, 2)}
+
+
+def occupied_slots(today: date) -> dict:
+    """Perfiles realmente ocupados por cuenta, en una sola consulta agrupada.
+
+    Cuenta las suscripciones que todavía no fueron reemplazadas por su
+    renovación y cuyo fin no pasó hace más de RENOVACION_GRACIA_DIAS: en ese
+    plazo se pueden renovar sin ocupar otro perfil (ver app.slot_released).
+    """
+    renewed = (
+        db.select(Subscription.renewed_from_id)
+        .where(Subscription.renewed_from_id.is_not(None))
+    )
+    return dict(db.session.execute(
+        db.select(Subscription.account_id, db.func.count())
+        .where(Subscription.end_date >= today - timedelta(days=RENOVACION_GRACIA_DIAS),
+               Subscription.id.not_in(renewed))
+        .group_by(Subscription.account_id)
+    ).all())
+
+
+def reconcile_slots(today: date = None, apply: bool = True) -> list:
+    """Corrige used_slots de las cuentas que no coinciden con lo ocupado.
+
+    Devuelve [(id, servicio, usuario, antes, ahora)] de las cuentas con
+    diferencias (el commit lo hace quien llama).
+    """
+    real = occupied_slots(today or date.today())
+    changes = [
+        (account_id, service, user, used or 0, real.get(account_id, 0))
+        for account_id, service, user, used in db.session.execute(
+            db.select(Account.id, Account.service, Account.user, Account.used_slots)
+            .order_by(Account.id)
+        )
+        if (used or 0) != real.get(account_id, 0)
+    ]
+    if apply and changes:
+        db.session.execute(
+            db.update(Account),
+            [{'id': account_id, 'used_slots': now} for account_id, _, _, _, now in changes],
+        )
+        invalidate_cache('accounts_libres')
+    return changes
+
+
+# --- REPORTE ---
+
+def slowest_queries(limit: int = 10) -> list:
+    """Consultas registradas como lentas, agrupadas por SQL y ordenadas por el peor tiempo."""
+    path = slow_query_log_path()
+    grouped = {}
+    for name in (path + '.1', path):
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                row = grouped.setdefault(entry['sql'], {
+                    'sql': entry['sql'], 'veces': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'ultima': '',
+                })
+                row['veces'] += 1
+                row['total_ms'] += entry['ms']
+                row['max_ms'] = max(row['max_ms'], entry['ms'])
+                row['ultima'] = max(row['ultima'], entry['fecha'])
+
+    rows = sorted(grouped.values(), key=lambda r: -r['max_ms'])[:limit]
+    for row in rows:
+        row['promedio_ms'] = round(row.pop('total_ms') / row['veces'], 1)
+    return rows
+
+
+def _sqlite_sizes(conn) -> dict:
+    """Bytes por tabla/índice según dbstat (None si SQLite se compiló sin él)."""
+    try:
+        return dict(conn.exec_driver_sql(
+            'SELECT name, SUM(pgsize) FROM dbstat GROUP BY name'
+        ).all())
+    except OperationalError:
+        return None
+
+
+def database_stats(slow_limit: int = 10) -> dict:
+    """Tamaño de tablas e índices, uso de índices y consultas más lentas."""
+    engine = current_engine()
+    tables = []
+    for table in db.metadata.sorted_tables:
+        rows = db.session.execute(db.select(db.func.count()).select_from(table)).scalar()
+        tables.append({'nombre': table.name, 'filas': rows, 'bytes': None})
+
+    indexes = []
+    with engine.connect() as conn:
+        if engine.dialect.name == 'sqlite':
+            page_size = conn.exec_driver_sql('PRAGMA page_size').scalar()
+            sizes = _sqlite_sizes(conn) or {}
+            stats = {}
+            if conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+            ).scalar():
+                stats = {idx: stat for idx, stat in conn.exec_driver_sql(
+                    'SELECT idx, stat FROM sqlite_stat1 WHERE idx IS NOT NULL')}
+            for table, name in conn.exec_driver_sql(
+                "SELECT tbl_name, name FROM sqlite_master WHERE type = 'index' ORDER BY tbl_name, name"
+            ):
+                stat = stats.get(name, '').split()
+                indexes.append({
+                    'tabla': table,
+                    'nombre': name,
+                    'bytes': sizes.get(name),
+                    # sqlite_stat1: filas y filas promedio por valor de la primera columna
+                    'filas_por_clave': int(stat[1]) if len(stat) > 1 else None,
+                    'analizado': bool(stat),
+                })
+            general = {
+                'bytes': conn.exec_driver_sql('PRAGMA page_count').scalar() * page_size,
+                'paginas_libres': conn.exec_driver_sql('PRAGMA freelist_count').scalar(),
+                'auto_vacuum': ('ninguno', 'completo', 'incremental')[
+                    conn.exec_driver_sql('PRAGMA auto_vacuum').scalar()],
+            }
+        else:
+            sizes = dict(conn.exec_driver_sql(
+                'SELECT relname, pg_total_relation_size(relid) FROM pg_stat_user_tables'
+            ).all())
+            for table, name, scans, size in conn.exec_driver_sql(
+                'SELECT relname, indexrelname, idx_scan, pg_relation_size(indexrelid) '
+                'FROM pg_stat_user_indexes ORDER BY relname, indexrelname'
+            ):
+                indexes.append({'tabla': table, 'nombre': name, 'bytes': size, 'lecturas': scans})
+            general = {'bytes': conn.exec_driver_sql(
+                'SELECT pg_database_size(current_database())').scalar()}
+
+    for table in tables:
+        table['bytes'] = sizes.get(table['nombre'])
+
+    last = get_state(MAINTENANCE_STATE_KEY)
+    return {
+        'motor': engine.dialect.name,
+        'general': general,
+        'tablas': sorted(tables, key=lambda t: -(t['bytes'] or t['filas'])),
+        'indices': indexes,
+        'consultas_lentas': slowest_queries(slow_limit),
+        'ultimo_mantenimiento': json.loads(last) if last else None,
+    }
+
+
+# --- EJECUCIÓN Y PROGRAMACIÓN ---
+
+def run_task(name: str) -> dict:
+    if name == 'perfiles':
+        changes = reconcile_slots()
+        db.session.commit()
+        return {'cuentas_corregidas': len(changes)}
+    if name == 'resumenes':
+        return {'clientes_recalculados': refresh_stale_summaries()}
+    if name == 'analizar':
+        return analyze()
+    if name == 'vacuum':
+        return vacuum()
+    if name == 'integridad':
+        return integrity_check()
+    raise ValueError(f'Tarea de mantenimiento desconocida: {name}')
+
+
+def run_maintenance(tasks=TAREAS, on_task=None) -> dict:
+    """Corre las tareas en orden y guarda el resultado en AppState."""
+    results = {}
+    for name in tasks:
+        results[name] = run_task(name)
+        if on_task:
+            on_task(name, results[name])
+
+    set_state(MAINTENANCE_STATE_KEY, json.dumps({
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'resultados': results,
+    }))
+    db.session.commit()
+    return results
+
+
+def next_maintenance_run(now: datetime = None, hour: int = None) -> datetime:
+    """Próxima vez que el reloj marque la hora de mantenimiento."""
+    now = now or datetime.now()
+    hour = app.config['MAINTENANCE_HOUR'] if hour is None else hour
+    run_at = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    return run_at if run_at > now else run_at + timedelta(days=1)
+
+
+def pending_maintenance():
+    return db.session.execute(
+        db.select(Job).where(Job.kind == 'mantenimiento', Job.status == 'pendiente')
+    ).scalars().all()
+
+
+def schedule_maintenance(hour: int = None, tasks=TAREAS) -> Job:
+    """Deja un único trabajo de mantenimiento periódico para la próxima madrugada."""
+    for job in pending_maintenance():
+        db.session.delete(job)
+    return enqueue('mantenimiento', {'tareas': list(tasks), 'hora': hour, 'repetir': True},
+                   run_at=next_maintenance_run(hour=hour), max_attempts=3)
@@ -1,9 +1,14 @@
-from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 import os
 import requests
+from sqlalchemy import or_
 
 # Importamos la app y modelos desde tu proyecto
-from app import app, Subscription, render_message, build_wa_link
+from app import (
+    app, db, Subscription, NotificationLog, render_message, message_template, build_wa_link,
+    get_state, set_state, list_tenants, tenant_context, current_tenant, reporting,
+)
 
 # === CONFIGURACIÓN DEL BOT TELEGRAM ===
 # Ahora viene desde variables de entorno (GitHub Actions y Fly.io)
@@ -13,6 +18,17 @@ TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 # Días antes para avisar vencimientos
 DIAS_ANTICIPACION = 3
 
+# Telegram rechaza mensajes de más de 4096 caracteres
+TELEGRAM_MAX_CHARS = 4000
+
+# Tenants revisados a la vez
+NOTIFIER_THREADS = int(os.getenv("NOTIFIER_THREADS", "8"))
+
+# Marcas de agua guardadas en AppState entre ejecuciones
+WM_CORTE = "notifier:corte_inicio"       # último start_date cubierto por avisos de pago
+WM_CAMBIO_PAGO = "notifier:cambio_pago"  # hasta cuándo se revisaron cambios de estado de pago
+WM_ULTIMO_ID = "notifier:ultimo_id"      # última suscripción revisada
+
 
 def send_telegram_message(text: str) -> bool:
     """Envía un mensaje a Telegram. Devuelve True si fue exitoso."""
@@ -49,6 +65,7 @@ def build_expiring_section(subs, today: date):
         "━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
     )
 
+    plantilla = message_template("recordatorio")
     for idx, s in enumerate(subs, start=1):
         dias = (s.end_date - today).days
         cliente = s.client.name if s.client else "Sin cliente"
@@ -57,7 +74,7 @@ def build_expiring_section(subs, today: date):
         estado_pago = s.payment_status.upper() if s.payment_status else "N/A"
 
         # Mensaje tipo "recordatorio"
-        mensaje = render_message("recordatorio", s)
+        mensaje = render_message("recordatorio", s, plantilla, today)
         wa_link = build_wa_link(s.client, mensaje) if s.platform == "whatsapp" else None
 
         lines.append(
@@ -81,6 +98,7 @@ def build_unpaid_section(subs, today: date):
         "━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
     )
 
+    plantilla = message_template("pago")
     for idx, s in enumerate(subs, start=1):
         dias_transcurridos = (today - s.start_date).days
         cliente = s.client.name if s.client else "Sin cliente"
@@ -90,7 +108,7 @@ def build_unpaid_section(subs, today: date):
         estado_pago = s.payment_status.upper() if s.payment_status else "N/A"
 
         # Mensaje tipo "pago"
-        mensaje = render_message("pago", s)
+        mensaje = render_message("pago", s, plantilla, today)
         wa_link = build_wa_link(s.client, mensaje) if s.platform == "whatsapp" else None
 
         lines.append(
@@ -104,55 +122,206 @@ def build_unpaid_section(subs, today: date):
     return "\n".join(lines)
 
 
-def check_and_notify():
-    """Revisa la base y envía notificaciones a Telegram."""
-    today = date.today()
-    limite = today + timedelta(days=DIAS_ANTICIPACION)
+def sent_fingerprints(kind: str, sub_ids):
+    """Devuelve {(subscription_id, fingerprint)} ya avisados para ese tipo."""
+    if not sub_ids:
+        return set()
+    rows = db.session.execute(
+        db.select(NotificationLog.subscription_id, NotificationLog.fingerprint)
+        .where(NotificationLog.kind == kind,
+               NotificationLog.subscription_id.in_(sub_ids))
+    )
+    return {tuple(r) for r in rows}
 
-    with app.app_context():
-        # Suscripciones por vencer
-        expiring = (
-            Subscription.query
-            .filter(Subscription.end_date >= today,
-                    Subscription.end_date <= limite)
-            .order_by(Subscription.end_date.asc())
-            .all()
-        )
 
-        # Pagos pendientes
-        unpaid = (
-            Subscription.query
-            .filter(
-                Subscription.payment_status != "pagado",
-                Subscription.start_date <= (today - timedelta(days=1))
-            )
-            .order_by(Subscription.start_date.asc())
-            .all()
-        )
+def expiring_fingerprint(s) -> str:
+    # Si la fecha de fin cambia (edición), se vuelve a avisar
+    return s.end_date.isoformat()
+
+
+def unpaid_fingerprint(s) -> str:
+    changed = s.payment_status_changed_at.isoformat() if s.payment_status_changed_at else ""
+    return f"{s.payment_status}@{changed}"
 
-        parts = []
 
-        expiring_text = build_expiring_section(expiring, today)
-        if expiring_text:
-            parts.append(expiring_text)
+def only_new(subs, kind: str, fingerprint):
+    """Descarta lo que ya se avisó con el mismo contenido según el registro."""
+    sent = sent_fingerprints(kind, [s.id for s in subs])
+    return [s for s in subs if (s.id, fingerprint(s)) not in sent]
 
-        unpaid_text = build_unpaid_section(unpaid, today)
-        if unpaid_text:
-            if parts:
-                parts.append("")  # separación
-            parts.append(unpaid_text)
 
-        if not parts:
-            print("No hay avisos para hoy.")
-            return
+def build_digest(today: date):
+    """Arma el aviso con solo lo nuevo o cambiado desde la última ejecución.
 
-        full_message = "\n".join(parts)
-        ok = send_telegram_message(full_message)
+    Las marcas de agua (AppState) limitan los pagos pendientes a candidatos
+    nuevos: inicios que superaron el día de gracia, pagos que cambiaron de
+    estado y suscripciones creadas después. Los vencimientos se revisan en toda
+    la ventana (es chica y va por índice), así una fecha de fin editada hacia
+    adentro también se avisa. El registro de avisos (NotificationLog) descarta
+    lo ya enviado, así que correr varias veces al día no repite nada.
 
-        if ok:
-            print("Notificación enviada correctamente.")
+    Devuelve un dict con 'text' (None si no hay novedades), 'entries' para
+    el registro y 'watermarks' a guardar una vez enviado.
+    """
+    limite = today + timedelta(days=DIAS_ANTICIPACION)
+    corte = today - timedelta(days=1)
+
+    # Marcas y registro de avisos se leen siempre de la base principal
+    wm_corte = get_state(WM_CORTE)
+    wm_cambio = get_state(WM_CAMBIO_PAGO)
+    wm_id = int(get_state(WM_ULTIMO_ID, 0))
+
+    # Los candidatos salen de la base de reportes, si su copia es posterior a
+    # la última revisión; la marca de cambios de pago avanza hasta la hora de
+    # esa copia, así lo que cambió después se revisa la próxima vez.
+    with reporting(fresher_than=datetime.fromisoformat(wm_cambio) if wm_cambio else None) as datos:
+        now = datos["datos_al"]
+        max_id = db.session.execute(db.select(db.func.max(Subscription.id))).scalar() or 0
+
+        # Suscripciones por vencer: toda la ventana; el registro descarta lo ya avisado
+        expiring_candidates = Subscription.query.filter(
+            Subscription.end_date >= today,
+            Subscription.end_date <= limite,
+        ).order_by(Subscription.end_date.asc()).all()
+
+        # Pagos pendientes: inicios recién vencidos, cambios de estado o ventas nuevas
+        unpaid_q = Subscription.query.filter(
+            Subscription.payment_status != "pagado",
+            Subscription.start_date <= corte,
+        )
+        if wm_corte and wm_cambio:
+            unpaid_q = unpaid_q.filter(or_(
+                Subscription.start_date > date.fromisoformat(wm_corte),
+                Subscription.payment_status_changed_at > datetime.fromisoformat(wm_cambio),
+                Subscription.id > wm_id,
+            ))
+        unpaid_candidates = unpaid_q.order_by(Subscription.start_date.asc()).all()
+
+        total_pendientes = Subscription.query.filter(
+            Subscription.payment_status != "pagado",
+            Subscription.start_date <= corte,
+        ).count()
+
+    expiring = only_new(expiring_candidates, "recordatorio", expiring_fingerprint)
+    unpaid = only_new(unpaid_candidates, "pago", unpaid_fingerprint)
+
+    watermarks = {
+        WM_CORTE: corte.isoformat(),
+        WM_CAMBIO_PAGO: now.isoformat(),
+        WM_ULTIMO_ID: max_id,
+    }
+    entries = (
+        [[s.id, "recordatorio", expiring_fingerprint(s)] for s in expiring]
+        + [[s.id, "pago", unpaid_fingerprint(s)] for s in unpaid]
+    )
+
+    if not entries:
+        return {"text": None, "entries": [], "watermarks": watermarks}
+
+    parts = [
+        f"🔔 <b>Novedades</b>: {len(expiring)} por vencer, "
+        f"{len(unpaid)} pagos pendientes nuevos ({total_pendientes} pendientes en total)"
+    ]
+
+    expiring_text = build_expiring_section(expiring, today)
+    if expiring_text:
+        parts.append("")
+        parts.append(expiring_text)
+
+    unpaid_text = build_unpaid_section(unpaid, today)
+    if unpaid_text:
+        parts.append("")  # separación
+        parts.append(unpaid_text)
+
+    return {"text": "\n".join(parts), "entries": entries, "watermarks": watermarks}
+
+
+def record_notified(entries, watermarks):
+    """Guarda en el registro lo enviado y avanza las marcas de agua."""
+    sent = {}
+    for sub_id, kind, fingerprint in entries:
+        sent.setdefault(kind, set()).add((sub_id, fingerprint))
+
+    for kind, items in sent.items():
+        existing = sent_fingerprints(kind, [sub_id for sub_id, _ in items])
+        for sub_id, fingerprint in items - existing:
+            db.session.add(NotificationLog(
+                subscription_id=sub_id, kind=kind, fingerprint=fingerprint
+            ))
+
+    for key, value in watermarks.items():
+        set_state(key, value)
+    db.session.commit()
+
+
+def split_message(text: str, limit: int = TELEGRAM_MAX_CHARS):
+    """Parte el texto en trozos que Telegram acepte, sin cortar líneas."""
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit and current:
+            chunks.append(current)
+            current = line
         else:
-            print("ERROR al enviar la notificación.")
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def tenant_header(text: str) -> str:
+    """Antepone el nombre del tenant al aviso, para saber de qué base es."""
+    tenant = current_tenant()
+    return f"🏷 <b>{tenant}</b>\n{text}" if tenant else text
+
+
+def notify_current(today: date):
+    """Envía las novedades de la base actual (principal o de un tenant).
+
+    Supone el esquema al día (`flask init-db --todos` después de cada actualización).
+    """
+    tenant = current_tenant()
+    etiqueta = f"[{tenant}] " if tenant else ""
+
+    digest = build_digest(today)
+
+    if not digest["text"]:
+        # Igual avanzamos las marcas para no volver a revisar lo mismo
+        record_notified([], digest["watermarks"])
+        print(f"{etiqueta}No hay avisos nuevos.")
+        return
+
+    ok = all(send_telegram_message(chunk) for chunk in split_message(tenant_header(digest["text"])))
+
+    if ok:
+        record_notified(digest["entries"], digest["watermarks"])
+        print(f"{etiqueta}Notificación enviada correctamente ({len(digest['entries'])} avisos).")
+    else:
+        print(f"{etiqueta}ERROR al enviar la notificación.")
+
+
+def notify_tenant(tenant, today: date):
+    with tenant_context(tenant):
+        try:
+            notify_current(today)
+        except Exception as e:
+            print(f"[{tenant or 'principal'}] Excepción revisando avisos:", e)
+
+
+def check_and_notify():
+    """Revisa la base (y la de cada tenant, en paralelo) y envía notificaciones a Telegram."""
+    today = date.today()
+
+    with app.app_context():
+        tenants = list_tenants()
+
+    if not tenants:
+        notify_tenant(None, today)
+        return
+
+    with ThreadPoolExecutor(max_workers=NOTIFIER_THREADS) as pool:
+        list(pool.map(lambda t: notify_tenant(t, today), [None] + tenants))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+import csv
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+from datetime import date
+
+from app import (
+    app, db, Subscription, Client, Account, Seller,
+    lease_job, complete_job, fail_job, job_checkpoint, LeaseLost, exports_dir,
+    subscription_history, archive_expired, ARCHIVE_AFTER_MONTHS,
+    list_tenants, tenant_context, current_tenant, reset_engines_after_fork, reporting, refresh_snapshot, schedule_snapshots,
+)
+
+# Segundos de espera cuando la cola está vacía
+POLL_INTERVAL = 5
+
+# Filas por lote en los trabajos largos (cada lote es un punto de control)
+BATCH_SIZE = 500
+
+
+# --- HANDLERS ---
+
+def handle_notificar(job):
+    """Envía a Telegram las novedades del día, un trozo a la vez.
+
+    El resumen se arma una sola vez y se guarda en el checkpoint, así un
+    reintento no vuelve a mandar los trozos que ya salieron. El registro de
+    avisos se actualiza recién cuando salió todo.
+    """
+    from notifier import build_digest, split_message, send_telegram_message, record_notified, tenant_header
+
+    progress = job.checkpoint
+    if 'chunks' not in progress:
+        digest = build_digest(date.today())
+        progress = {
+            'chunks': split_message(tenant_header(digest['text'])) if digest['text'] else [],
+            'sent': 0,
+            'entries': digest['entries'],
+            'watermarks': digest['watermarks'],
+        }
+        job_checkpoint(job, **progress)
+
+    chunks = progress['chunks']
+    for idx in range(progress['sent'], len(chunks)):
+        if not send_telegram_message(chunks[idx]):
+            raise RuntimeError(f'Telegram rechazó el trozo {idx + 1} de {len(chunks)}')
+        job_checkpoint(job, sent=idx + 1)
+
+    record_notified(progress['entries'], progress['watermarks'])
+    print(f"[worker] {job_label(job)}: {len(progress['entries'])} avisos enviados")
+
+
+def handle_vencimientos(job):
+    """Marca como 'vencida' las suscripciones activas cuyo fin ya pasó, por lotes."""
+    today = date.fromisoformat(job.data.get('fecha', date.today().isoformat()))
+    procesadas = job.checkpoint.get('procesadas', 0)
+
+    while True:
+        ids = [
+            row[0] for row in db.session.execute(
+                db.select(Subscription.id)
+                .where(Subscription.status == 'activa', Subscription.end_date < today)
+                .limit(BATCH_SIZE)
+            )
+        ]
+        if not ids:
+            break
+
+        db.session.execute(
+            db.update(Subscription)
+            .where(Subscription.id.in_(ids))
+            .values(status='vencida')
+        )
+        procesadas += len(ids)
+        job_checkpoint(job, procesadas=procesadas)  # hace commit del lote
+
+
+def handle_exportar_ventas(job):
+    """Escribe todas las ventas a un CSV, por lotes ordenados por id.
+
+    Si el worker se cae, el siguiente intento sigue agregando filas desde el
+    último id guardado en el checkpoint.
+    """
+    nombre = os.path.basename(job.data.get('nombre') or f'ventas-{job.id}.csv')
+    path = os.path.join(exports_dir(), nombre)
+    progress = job.checkpoint
+    last_id = progress.get('last_id', 0)
+
+    if last_id and (not os.path.exists(path) or os.path.getsize(path) < progress['bytes']):
+        # El archivo parcial no está (otra máquina, instance/ limpiado): se empieza de nuevo
+        last_id = 0
+
+    if last_id:
+        # Un intento anterior pudo escribir filas después de su último checkpoint
+        with open(path, 'r+b') as f:
+            f.truncate(progress['bytes'])
+    else:
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow([
+                'id', 'cliente', 'telefono', 'servicio', 'cuenta', 'vendedor',
+                'inicio', 'fin', 'precio', 'moneda', 'plataforma', 'estado_pago', 'slot',
+            ])
+
+    # Incluye las suscripciones archivadas
+    hist = subscription_history()
+
+    while True:
+        # La lectura va a la base de reportes; el checkpoint se escribe en la principal
+        with reporting():
+            rows = db.session.execute(
+                db.select(
+                    hist.c.id, Client.name, Client.phone, Account.service, Account.user,
+                    Seller.name, hist.c.start_date, hist.c.end_date,
+                    hist.c.price, hist.c.currency, hist.c.platform,
+                    hist.c.payment_status, hist.c.slot,
+                )
+                .join(Client, hist.c.client_id == Client.id)
+                .join(Account, hist.c.account_id == Account.id)
+                .outerjoin(Seller, hist.c.seller_id == Seller.id)
+                .where(hist.c.id > last_id)
+                .order_by(hist.c.id.asc())
+                .limit(BATCH_SIZE)
+            ).all()
+        if not rows:
+            break
+
+        with open(path, 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(rows)
+            size = f.tell()
+
+        last_id = rows[-1][0]
+        job_checkpoint(job, last_id=last_id, bytes=size, archivo=nombre)
+
+
+def handle_archivar(job):
+    """Mueve al archivo las suscripciones vencidas hace tiempo (cada lote es su propia transacción)."""
+    months = job.data.get('meses', ARCHIVE_AFTER_MONTHS)
+    archived = job.checkpoint.get('archivadas', 0)
+    archive_expired(
+        months, BATCH_SIZE,
+        on_batch=lambda n: job_checkpoint(job, archivadas=archived + n),
+    )
+
+
+def handle_pronostico(job):
+    """Recalcula el pronóstico del día para que el panel no espere (útil desde cron)."""
+    from forecast import cached_forecast
+    cached_forecast(date.today(), refresh=True)
+
+
+def handle_mantenimiento(job):
+    """Tareas de mantenimiento de la base; si es periódico, deja programada la próxima.
+
+    Cada tarea terminada queda en el checkpoint, así un reintento no repite
+    (por ejemplo) un vacuum que ya se hizo.
+    """
+    from maintenance import TAREAS, run_maintenance, schedule_maintenance
+
+    data = job.data
+    hechas = job.checkpoint.get('hechas', [])
+    pendientes = [t for t in data.get('tareas', TAREAS) if t not in hechas]
+    run_maintenance(pendientes, on_task=lambda name, _: (
+        hechas.append(name), job_checkpoint(job, hechas=hechas)))
+
+    if data.get('repetir'):
+        schedule_maintenance(data.get('hora'), data.get('tareas', TAREAS))
+
+
+def handle_snapshot_reportes(job):
+    """Refresca la copia de solo lectura para reportes y, si es periódico, programa la siguiente."""
+    refresh_snapshot()
+    if job.data.get('repetir'):
+        schedule_snapshots(job.data.get('minutos'))
+
+
+HANDLERS = {
+    'notificar': handle_notificar,
+    'vencimientos': handle_vencimientos,
+    'exportar_ventas': handle_exportar_ventas,
+    'archivar': handle_archivar,
+    'pronostico': handle_pronostico,
+    'mantenimiento': handle_mantenimiento,
+    'snapshot_reportes': handle_snapshot_reportes,
+}
+
+
+# --- BUCLE DEL WORKER ---
+
+def job_label(job) -> str:
+    tenant = current_tenant()
+    return f"trabajo #{job.id} ({job.kind}{', ' + tenant if tenant else ''})"
+
+
+def run_job(job):
+    handler = HANDLERS.get(job.kind)
+    if handler is None:
+        fail_job(job, f'Tipo de trabajo desconocido: {job.kind}')
+        return
+
+    lost = f'[worker] {job_label(job)}: la reserva venció y lo tomó otro worker; se descarta este intento'
+    try:
+        handler(job)
+    except LeaseLost:
+        db.session.rollback()
+        print(lost)
+    except Exception:
+        db.session.rollback()
+        attempt = job.lease[1]
+        if fail_job(job, traceback.format_exc(limit=5)):
+            print(f'[worker] {job_label(job)} falló, intento {attempt}/{job.max_attempts}')
+        else:
+            print(lost)
+    else:
+        print(f'[worker] {job_label(job)} terminado' if complete_job(job) else lost)
+
+
+def work_once(worker_id: str) -> bool:
+    """Atiende un trabajo de cada base (principal y tenants). True si hubo alguno."""
+    worked = False
+    with app.app_context():
+        tenants = [None] + list_tenants()
+
+    for tenant in tenants:
+        with tenant_context(tenant):
+            job = lease_job(worker_id)
+            if job is not None:
+                run_job(job)
+                worked = True
+    return worked
+
+
+def work(worker_id: str, once: bool = False):
+    """Toma trabajos de la cola hasta que se detenga el proceso (o se vacíe, si once)."""
+    with app.app_context():
+        # Las conexiones heredadas del proceso padre no se comparten
+        reset_engines_after_fork()
+
+    while True:
+        if not work_once(worker_id):
+            if once:
+                return
+            time.sleep(POLL_INTERVAL)
+
+
+def run_workers(processes: int = 1, once: bool = False):
+    base_id = f'{socket.gethostname()}:{os.getpid()}'
+
+    if processes <= 1:
+        work(f'{base_id}:0', once=once)
+        return
+
+    procs = [
+        multiprocessing.Process(target=work, args=(f'{base_id}:{n}', once), daemon=True)
+        for n in range(processes)
+    ]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()